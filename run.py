@@ -1,4 +1,5 @@
 import json
+import os
 import sys
 import time
 
@@ -7,6 +8,10 @@ import boto3
 client = boto3.client('lambda')
 writer_lambda_name = 'dataplatform-play-monitoring-events-writer-v1'
 reader_lambda_name = 'dataplatform-play-monitoring-events-reader-v1'
+# "closed" or "open" runs the reader as a load generator instead
+load_mode = os.getenv("LOAD_MODE")
+# Has the writer run the query mix while it writes its stage waves
+mixed_read_write = os.getenv("MIXED_READ_WRITE", "false") == "true"
 
 
 def _write(num_runs_per_iter):
@@ -17,6 +22,7 @@ def _write(num_runs_per_iter):
                 FunctionName=writer_lambda_name,
                 InvocationType='Event',
                 LogType='None',
+                Payload=json.dumps({"mixed_read_write": mixed_read_write})
             )
             runs_this_iter = i + 1
             print(f"Triggered {runs_this_iter} runs", end="\r")
@@ -28,13 +34,18 @@ def _write(num_runs_per_iter):
     print(f"Triggered {runs_this_iter} runs")
 
 
-def _read(scale):
+def _read(scale, write_start_time):
     try:
         client.invoke(
             FunctionName=reader_lambda_name,
             InvocationType='Event',
             LogType='None',
-            Payload=json.dumps({"scale": scale})
+            Payload=json.dumps({
+                "scale": scale,
+                "write_start_time": write_start_time,
+                "write_end_time": int(time.time() * 1000),
+                "load_mode": load_mode,
+            })
         )
         print("Triggered querying")
         time.sleep(420)
@@ -47,11 +58,12 @@ def main():
     num_runs_per_iter = 10
     target_num_iters = 8
     current_iter = 0
+    write_start_time = int(time.time() * 1000)
     while current_iter < target_num_iters:
         _write(num_runs_per_iter)
         current_iter += 1
         scale = f"{current_iter}x"
-        _read(scale)
+        _read(scale, write_start_time)
 
 
 if __name__ == "__main__":
@@ -1,105 +1,183 @@
+import concurrent.futures
 import json
 import os
+import threading
 import time
 from logging import Logger
-from typing import List
+from typing import Dict, Iterator, List, Tuple
 
 import boto3
 from botocore.exceptions import ClientError
 
 from src.helpers import (
-    create_batches_from_list,
-    get_unix_timestamp,
+    get_unix_timestamp_ms,
     get_timestamp_with_offset, timed_operation
 )
 
 log = Logger(name="cloudwatch")
 cw_logs = boto3.client('logs')
 log_group = os.getenv("CLOUDWATCH_LOG_GROUP")
-batch_size = 500
+# Events are spread over this many log streams, written in parallel
+num_log_stream_shards = int(os.getenv("CW_LOG_STREAM_SHARDS", "4"))
+# Insights queries: results are polled with a short initial interval that
+# backs off, and at most this many queries are started at once. The capped
+# interval bounds how late a finished query is noticed, so it is kept low
+query_poll_initial_interval = float(os.getenv("CW_QUERY_POLL_INITIAL_INTERVAL", "0.05"))
+query_poll_max_interval = float(os.getenv("CW_QUERY_POLL_MAX_INTERVAL", "0.15"))
+query_poll_backoff = 1.5
+max_concurrent_queries = int(os.getenv("CW_MAX_CONCURRENT_QUERIES", "10"))
+# Window used when the range of written events is not known
+query_lookback_days = 7
 
+# PutLogEvents limits: the batch size counts every message's UTF-8 bytes
+# plus a fixed overhead per event, and a batch may span at most 24 hours
+max_batch_bytes = 1048576
+event_overhead_bytes = 26
+max_batch_events = 10000
+max_batch_span_ms = 24 * 60 * 60 * 1000
 
-def _put_log_events(kwargs, this_batch_size):
-    with timed_operation("cloudwatch_logs", "basic_write", num_records=this_batch_size):
-        try:
-            return cw_logs.put_log_events(**kwargs)
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "InvalidSequenceTokenException":
-                log_stream_name = kwargs.get("logStreamName")
-                response = cw_logs.describe_log_streams(
-                    logGroupName=kwargs.get("logGroupName"),
-                    logStreamNamePrefix=log_stream_name
-                )
-                if "logStreams" in response and len(response.get("logStreams")) > 0:
-                    log_stream = response.get("logStreams")[0]
-                    if log_stream.get("logStreamName") == log_stream_name:
-                        kwargs["sequenceToken"] = log_stream.get("uploadSequenceToken")
-                        return cw_logs.put_log_events(**kwargs)
-            raise e
+# Next sequence token per (log group, log stream), so that consecutive
+# batches never have to look it up
+_sequence_tokens: Dict[Tuple[str, str], str] = {}
+_sequence_tokens_lock = threading.Lock()
 
 
-def write_many(log_stream: str, items: List[dict]):
-    if len(items) == 0:
-        return
+def _pack_batches(log_events: List[dict]) -> Iterator[List[dict]]:
+    """
+    Packs log events (sorted by timestamp) into the largest batches
+    PutLogEvents accepts.
+    """
+    batch = []
+    batch_bytes = 0
+    for event in log_events:
+        event_bytes = len(event["message"].encode()) + event_overhead_bytes
+        is_full = (
+            len(batch) >= max_batch_events
+            or batch_bytes + event_bytes > max_batch_bytes
+            or (batch and event["timestamp"] - batch[0]["timestamp"] > max_batch_span_ms)
+        )
+        if is_full:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(event)
+        batch_bytes += event_bytes
+    if batch:
+        yield batch
 
-    sequence_token = None
-    batches = create_batches_from_list(items, batch_size)
-    for batch in batches:
-        this_batch_size = len(batch)
-        kwargs = {
-            "logGroupName": log_group,
-            "logStreamName": log_stream,
-            "logEvents": [
-                {
-                    "timestamp": item.pop("time"),
-                    "message": json.dumps(item),
-                }
-                for item in batch
-            ]
+
+def _create_log_stream(log_stream: str):
+    log.info(
+        {
+            "message": "Creating new log stream",
+            "log_group": log_group,
+            "log_stream": log_stream
         }
-        if sequence_token is not None:
-            kwargs["sequenceToken"] = sequence_token
-        try:
-            response = _put_log_events(kwargs, this_batch_size)
-            sequence_token = response.get("nextSequenceToken")
-        except ClientError as e:
-            if e.response["Error"]["Code"] == "ResourceNotFoundException":
-                log.info(
-                    {
-                        "message": "Creating new log stream",
-                        "log_group": log_group,
-                        "log_stream": log_stream
-                    }
-                )
-                try:
-                    cw_logs.create_log_stream(
-                        logGroupName=log_group,
-                        logStreamName=log_stream
-                    )
-                except ClientError as e:
-                    if e.response["Error"]["Code"] == "ResourceAlreadyExistsException":
-                        pass
-                    else:
-                        raise e
-                response = _put_log_events(kwargs, this_batch_size)
-                sequence_token = response.get("nextSequenceToken")
-            elif e.response["Error"]["Code"] == "InvalidSequenceTokenException":
-                log.info(
-                    {
-                        "message": "Attempted putting events with "
-                                   "invalid sequence token",
-                        "log_group": log_group,
-                        "log_stream": log_stream
-                    }
-                )
-                sequence_token = e.response.get("expectedSequenceToken")
+    )
+    try:
+        cw_logs.create_log_stream(
+            logGroupName=log_group,
+            logStreamName=log_stream
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceAlreadyExistsException":
+            raise e
+
+
+def _put_log_events(log_stream: str, batch: List[dict], num_shards: int):
+    stream_key = (log_group, log_stream)
+    kwargs = {
+        "logGroupName": log_group,
+        "logStreamName": log_stream,
+        "logEvents": batch,
+    }
+    with timed_operation(
+        "cloudwatch_logs",
+        "basic_write",
+        num_records=len(batch),
+        num_shards=num_shards,
+    ):
+        for _ in range(3):
+            with _sequence_tokens_lock:
+                sequence_token = _sequence_tokens.get(stream_key)
+            if sequence_token is not None:
                 kwargs["sequenceToken"] = sequence_token
-                response = _put_log_events(kwargs, this_batch_size)
-                sequence_token = response.get("nextSequenceToken")
             else:
+                kwargs.pop("sequenceToken", None)
+
+            try:
+                response = cw_logs.put_log_events(**kwargs)
+            except ClientError as e:
+                error_code = e.response["Error"]["Code"]
+                if error_code == "ResourceNotFoundException":
+                    _create_log_stream(log_stream)
+                    continue
+                if error_code in (
+                    "InvalidSequenceTokenException",
+                    "DataAlreadyAcceptedException"
+                ):
+                    # The error carries the token to use, so no describe call
+                    # is needed
+                    with _sequence_tokens_lock:
+                        _sequence_tokens[stream_key] = e.response.get(
+                            "expectedSequenceToken"
+                        )
+                    if error_code == "DataAlreadyAcceptedException":
+                        return
+                    continue
                 log.exception(e)
                 raise e
 
+            with _sequence_tokens_lock:
+                _sequence_tokens[stream_key] = response.get("nextSequenceToken")
+            return
+        raise Exception(f"Could not put log events into {log_stream}")
+
+
+def _write_stream(log_stream: str, log_events: List[dict], num_shards: int):
+    for batch in _pack_batches(log_events):
+        _put_log_events(log_stream, batch, num_shards)
+
+
+def write_many(log_stream: str, items: List[dict], num_shards: int = None):
+    """
+    Writes items as log events, spread round-robin over `num_shards` log
+    streams (`<log_stream>/<shard>`) that are written in parallel, each with
+    batches packed up to the PutLogEvents limits.
+    """
+    if len(items) == 0:
+        return
+
+    num_shards = num_shards or num_log_stream_shards
+    log_events = sorted(
+        (
+            {
+                "timestamp": item["time"],
+                "message": json.dumps(
+                    {field: value for field, value in item.items() if field != "time"}
+                ),
+            }
+            for item in items
+        ),
+        key=lambda event: event["timestamp"]
+    )
+    if num_shards == 1:
+        _write_stream(log_stream, log_events, 1)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_shards) as executor:
+        futures = [
+            executor.submit(
+                _write_stream,
+                f"{log_stream}/{shard}",
+                log_events[shard::num_shards],
+                num_shards
+            )
+            for shard in range(num_shards)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
 
 def get_many(
     log_stream,
@@ -187,19 +265,137 @@ def search(
     return items, next_page_cursor
 
 
-def query(query_string):
-    start_time = get_unix_timestamp()
-    kwargs = {
-        "logGroupName": log_group,
-        "startTime": start_time,
-        "endTime": get_timestamp_with_offset(start_time, days=7),
-        "queryString": query_string,
-    }
-    response = cw_logs.start_query(**kwargs)
-    query_id = response.get("queryId")
-    response = cw_logs.get_query_results(queryId=query_id)
-    while response.get("status") in {"Scheduled", "Running"}:
-        time.sleep(1)
+def query_window(start_time: int = None, end_time: int = None) -> Tuple[int, int]:
+    """
+    Returns the (start, end) of an Insights query window, in epoch seconds.
+
+    Args:
+        start_time: Start of the written events' range (epoch ms); defaults to
+            `query_lookback_days` before `end_time`
+        end_time: End of the written events' range (epoch ms); defaults to now
+    """
+    if end_time is None:
+        end_time = get_unix_timestamp_ms()
+    if start_time is None:
+        start_time = get_timestamp_with_offset(
+            end_time // 1000, days=query_lookback_days, ahead=False
+        )
+    # Insights windows are whole seconds, so round outwards
+    return start_time // 1000, -(-end_time // 1000)
+
+
+def _start_query(query_string: str, start_time: int, end_time: int) -> str:
+    delay = query_poll_initial_interval
+    while True:
+        try:
+            response = cw_logs.start_query(
+                logGroupName=log_group,
+                startTime=start_time,
+                endTime=end_time,
+                queryString=query_string,
+            )
+            return response.get("queryId")
+        except ClientError as e:
+            # Queries started by other processes count against the same limit
+            if e.response["Error"]["Code"] != "LimitExceededException":
+                raise e
+            time.sleep(delay)
+            delay = min(delay * query_poll_backoff, query_poll_max_interval)
+
+
+def _get_query_results(query_id: str) -> Tuple[bool, list]:
+    try:
         response = cw_logs.get_query_results(queryId=query_id)
+    except ClientError as e:
+        # Polling this often can hit the GetQueryResults rate limit; the
+        # query is simply polled again
+        if e.response["Error"]["Code"] == "ThrottlingException":
+            return False, None
+        raise
+    status = response.get("status")
+    if status in {"Scheduled", "Running"}:
+        return False, None
+    if status != "Complete":
+        raise Exception(f"Insights query {query_id} ended with status {status}")
+    return True, response.get("results")
+
 
-    return response.get("results")
+def query(query_string, start_time: int = None, end_time: int = None):
+    """
+    Runs an Insights query over the log group and returns its results.
+    Results are polled at `query_poll_initial_interval`, backing off up to
+    `query_poll_max_interval`.
+
+    Args:
+        start_time: Start of the written events' range (epoch ms)
+        end_time: End of the written events' range (epoch ms)
+    """
+    query_id = _start_query(query_string, *query_window(start_time, end_time))
+    delay = query_poll_initial_interval
+    while True:
+        done, results = _get_query_results(query_id)
+        if done:
+            return results
+        time.sleep(delay)
+        delay = min(delay * query_poll_backoff, query_poll_max_interval)
+
+
+def query_many(
+    query_strings: List[str],
+    start_time: int = None,
+    end_time: int = None,
+    max_concurrent: int = None
+) -> List[Tuple[list, float]]:
+    """
+    Runs Insights queries concurrently, keeping at most `max_concurrent` of
+    them started at once (the service limits concurrent queries per account).
+
+    If a query fails, the others still running are stopped before the error
+    is raised, so that they do not hold on to concurrent-query slots.
+
+    Returns:
+        A (results, latency in seconds) pair per query, in the given order
+    """
+    max_concurrent = max_concurrent or max_concurrent_queries
+    window = query_window(start_time, end_time)
+    pending = list(enumerate(query_strings))[::-1]
+    in_flight = {}
+    outcomes = [None] * len(query_strings)
+    delay = query_poll_initial_interval
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_concurrent:
+                i, query_string = pending.pop()
+                in_flight[i] = (_start_query(query_string, *window), time.perf_counter())
+            time.sleep(delay)
+            completed = False
+            for i, (query_id, started_at) in list(in_flight.items()):
+                done, results = _get_query_results(query_id)
+                if done:
+                    outcomes[i] = (results, time.perf_counter() - started_at)
+                    del in_flight[i]
+                    completed = True
+            # Poll quickly again once a slot frees up, back off while all wait
+            if completed:
+                delay = query_poll_initial_interval
+            else:
+                delay = min(delay * query_poll_backoff, query_poll_max_interval)
+    except Exception:
+        _stop_queries([query_id for query_id, _ in in_flight.values()])
+        raise
+    return outcomes
+
+
+def _stop_queries(query_ids: List[str]):
+    for query_id in query_ids:
+        try:
+            cw_logs.stop_query(queryId=query_id)
+        except ClientError as e:
+            # Queries that have already ended cannot be stopped
+            log.info(
+                {
+                    "message": "Could not stop query",
+                    "query_id": query_id,
+                    "error": repr(e)
+                }
+            )
@@ -1,20 +1,124 @@
 import concurrent.futures
+import functools
+import gzip
 import json
 import os
+import random
 import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 from http import HTTPStatus
 from logging import Logger
-from typing import Callable, List
+from typing import Callable, Iterator, List, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from src.helpers import get_awsauth, timed_operation
 
 ES_CONTENT_HEADERS = {'Content-Type': 'application/json'}
+ES_BULK_HEADERS = {'Content-Type': 'application/x-ndjson'}
 DEFAULT_PAGE_SIZE = 1000
+# Appended to every search_after sort, so that sort positions are unique
+SEARCH_AFTER_TIEBREAKER = [{"time": "asc"}, {"job_id": "asc"}]
+BULK_MAX_WORKERS = 10
+# Bulk requests are cut once their body reaches this many bytes. A stage wave
+# is about 5-6 MB of NDJSON, so 1 MB bodies keep most of the workers busy.
+BULK_MAX_BYTES = int(os.getenv("ES_BULK_MAX_BYTES", str(1024 * 1024)))
+# Documents still rejected after this many resends of a bulk batch are dropped
+BULK_MAX_RETRIES = int(os.getenv("ES_BULK_MAX_RETRIES", "6"))
+BULK_RETRY_BASE_DELAY = 0.5
+BULK_RETRY_MAX_DELAY = 30
+# Kept-alive connections of the shared session. Bulk workers share it with
+# query load running alongside (up to LOAD_OPEN_LOOP_MAX_WORKERS, 64 by
+# default); threads beyond the pool would open a connection and discard it
+HTTP_POOL_SIZE = int(os.getenv("ES_HTTP_POOL_SIZE", str(BULK_MAX_WORKERS + 64)))
+# "single" writes to and queries one index, "rolled" writes through a write
+# alias to indices rolled over by age/size and queries them through a read
+# alias. Timings are recorded under a separate data store per layout.
+index_layouts = ("single", "rolled")
+index_layout = os.getenv("ES_INDEX_LAYOUT", "single")
+data_store = "elasticsearch" if index_layout == "single" else "elasticsearch_rolled"
+rollover_conditions = {
+    "max_age": os.getenv("ES_ROLLOVER_MAX_AGE", "1d"),
+    "max_size": os.getenv("ES_ROLLOVER_MAX_SIZE", "5gb"),
+}
+# Rolled indices created longer ago than this are deleted (0 keeps them all)
+index_retention_days = float(os.getenv("ES_INDEX_RETENTION_DAYS", "0"))
+# Bulk writes run with refreshes off (and optionally without replicas and with
+# async translog durability) while the writer has ingest mode enabled
+ingest_mode_enabled = os.getenv("ES_INGEST_MODE", "false") == "true"
+ingest_mode_drop_replicas = os.getenv("ES_INGEST_DROP_REPLICAS", "false") == "true"
+ingest_mode_async_translog = os.getenv("ES_INGEST_ASYNC_TRANSLOG", "false") == "true"
+INGEST_MODE_META_KEY = "ingest_mode_saved_settings"
+RETRYABLE_STATUSES = {
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+}
 log = Logger(name="elasticsearch")
 elastic_url = "https://" + os.getenv("ES_DOMAIN_URL") + "/"
 auth = get_awsauth(os.getenv("AWS_REGION"), "es")
+# Both toggles exist so that the benchmark can measure what they save
+reuse_connections = os.getenv("ES_REUSE_CONNECTIONS", "true") == "true"
+compress_requests = os.getenv("ES_COMPRESS_REQUESTS", "true") == "true"
+
+
+def _create_session() -> requests.Session:
+    _session = requests.Session()
+    _session.auth = auth
+    _session.headers["Accept-Encoding"] = "gzip"
+    # Sized so that every bulk worker and reader thread gets a kept-alive
+    # connection of its own
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+    _session.mount("https://", adapter)
+    return _session
+
+
+@dataclass
+class BulkResult:
+    raw_bytes: int = 0
+    sent_bytes: int = 0
+    retried_docs: int = 0
+    dropped_docs: int = 0
+    compress_ns: int = 0
+    send_ns: int = 0
+    server_took_ms: int = 0
+
+    def merge(self, other: "BulkResult"):
+        self.raw_bytes += other.raw_bytes
+        self.sent_bytes += other.sent_bytes
+        self.compress_ns += other.compress_ns
+        self.send_ns += other.send_ns
+        self.server_took_ms += other.server_took_ms
+        self.retried_docs += other.retried_docs
+        self.dropped_docs += other.dropped_docs
+
+
+@dataclass
+class AggregationStats:
+    pages: int = 0
+    buckets: int = 0
+    request_ns: int = 0
+    server_took_ms: int = 0
+
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+session = _create_session()
+# Either the shared keep-alive session, or the module-level requests functions
+# (a new connection per request); both expose get/put/post/head/delete
+http = session if reuse_connections else requests
 
 
 def _check_response(response, operation_name, ignored_errors=None, err_title=None):
@@ -46,12 +150,13 @@ def _check_response(response, operation_name, ignored_errors=None, err_title=Non
                 error_data = None
         if has_multiple_errors:
             error_data = []
-            for item in response_data.get("items"):
-                item_error = item.get("error")
-                if item_error.get("type") in ignored_errors:
+            for item in response_data.get("items", []):
+                # Bulk items are keyed by their action, e.g. {"index": {...}}
+                item_result = next(iter(item.values()), None) or {}
+                item_error = item_result.get("error")
+                if not item_error or item_error.get("type") in ignored_errors:
                     continue
-                if item_error:
-                    error_data.append(item_error)
+                error_data.append(item_error)
 
         if error_data:
             log.warning(
@@ -69,16 +174,102 @@ def _check_response(response, operation_name, ignored_errors=None, err_title=Non
 
 def create_index_if_not_exists(index: str, index_settings: dict):
     index_url = elastic_url + index
-    resp = requests.head(index_url, auth=auth)
+    resp = http.head(index_url, auth=auth)
     index_not_present = resp.status_code == 404
     if index_not_present:
         log.info("Creating new index: " + index)
-        resp = requests.put(index_url, auth=auth, json=index_settings)
+        resp = http.put(index_url, auth=auth, json=index_settings)
         _check_response(resp, "create_index_if_not_exists")
 
 
+def write_target(index: str) -> str:
+    return f"{index}_write" if index_layout == "rolled" else index
+
+
+def read_target(index: str) -> str:
+    return f"{index}_read" if index_layout == "rolled" else index
+
+
+def put_index_template(name: str, index_patterns: List[str], template: dict):
+    resp = http.put(
+        f"{elastic_url}_index_template/{name}",
+        auth=auth,
+        json={"index_patterns": index_patterns, "template": template}
+    )
+    _check_response(resp, "put_index_template")
+
+
+def alias_exists(alias: str) -> bool:
+    resp = http.head(f"{elastic_url}_alias/{alias}", auth=auth)
+    return not resp.status_code == HTTPStatus.NOT_FOUND
+
+
+def get_alias_indices(alias: str) -> dict:
+    resp = http.get(f"{elastic_url}_alias/{alias}", auth=auth)
+    if resp.status_code == HTTPStatus.NOT_FOUND:
+        return {}
+    return _check_response(resp, "get_alias_indices")
+
+
+def bootstrap_rolled_index(index: str):
+    """
+    Creates the first of the rolled `index`-NNNNNN indices, with the write
+    alias pointing at it, unless the write alias already exists.
+    """
+    alias = write_target(index)
+    if alias_exists(alias):
+        return
+    log.info("Creating first rolled index for: " + alias)
+    resp = http.put(
+        f"{elastic_url}{index}-000001",
+        auth=auth,
+        json={"aliases": {alias: {"is_write_index": True}}}
+    )
+    _check_response(
+        resp,
+        "bootstrap_rolled_index",
+        ignored_errors={"resource_already_exists_exception"}
+    )
+
+
+def rollover(alias: str, conditions: dict) -> dict:
+    resp = http.post(
+        f"{elastic_url}{alias}/_rollover",
+        auth=auth,
+        json={"conditions": conditions}
+    )
+    result = _check_response(resp, "rollover", err_title=f"{alias} rollover failed")
+    if result.get("rolled_over"):
+        log.info(f"Rolled {alias} over to {result.get('new_index')}")
+    return result
+
+
+def delete_expired_indices(index: str, retention_days: float) -> List[str]:
+    """
+    Deletes the rolled `index`-NNNNNN indices created more than
+    `retention_days` ago, except the one the write alias points at.
+    """
+    resp = http.get(
+        f"{elastic_url}_cat/indices/{index}-*?h=index,creation.date&format=json",
+        auth=auth
+    )
+    if resp.status_code == HTTPStatus.NOT_FOUND:
+        return []
+    current_write_indices = set(get_alias_indices(write_target(index)))
+    cutoff = (time.time() - retention_days * 86400) * 1000
+    deleted = []
+    for index_info in resp.json():
+        index_name = index_info.get("index")
+        if index_name in current_write_indices:
+            continue
+        if int(index_info.get("creation.date")) < cutoff:
+            delete_index(index_name)
+            deleted.append(index_name)
+    return deleted
+
+
 def index_document(index: str, document: dict, doc_id: str):
-    resp = requests.post(
+    resp = http.post(
         f"{elastic_url}{index}/_doc/{doc_id}",
         auth=auth,
         json=document
@@ -87,50 +278,90 @@ def index_document(index: str, document: dict, doc_id: str):
     return resp
 
 
+def _bulk_bodies(
+    index: str,
+    documents: List[dict],
+    doc_ids: List[str] = None,
+    max_bytes: int = BULK_MAX_BYTES,
+) -> Iterator[Tuple[bytes, int]]:
+    """
+    Encodes documents straight into a reusable NDJSON buffer and yields a
+    bulk body (and its document count) whenever the next document would push
+    it past `max_bytes`.
+    """
+    use_doc_ids = doc_ids is not None and len(doc_ids) == len(documents)
+    action_line = _dumps({"index": {"_index": index, "_type": "_doc"}}) + b"\n"
+    buffer = bytearray()
+    num_docs = 0
+    for i, document in enumerate(documents):
+        if use_doc_ids:
+            action_line = _dumps(
+                {"index": {"_index": index, "_type": "_doc", "_id": doc_ids[i]}}
+            ) + b"\n"
+        document_line = _dumps(document)
+        item_size = len(action_line) + len(document_line) + 1
+        if num_docs > 0 and len(buffer) + item_size > max_bytes:
+            yield bytes(buffer), num_docs
+            buffer.clear()
+            num_docs = 0
+        buffer += action_line
+        buffer += document_line
+        buffer += b"\n"
+        num_docs += 1
+    if num_docs > 0:
+        yield bytes(buffer), num_docs
+
+
 def index_documents_in_bulk(
     index: str,
     documents: List[dict],
     doc_ids: List[str] = None,
-    batch_size=500,
+    max_bytes: int = BULK_MAX_BYTES,
 ):
-    def action_item(idx: int):
-        if doc_ids is not None and len(doc_ids) == len(documents):
-            return {
-                "index": {"_index": index, "_type": "_doc", "_id": doc_ids[idx]}
-            }
-        return {"index": {"_index": index, "_type": "_doc"}}
-
-    batches_of_actions = []
-    actions = []
-    for i, document in enumerate(documents):
-        actions.append(json.dumps(action_item(i)))
-        actions.append(json.dumps(document))
-
-        is_full_batch = (i + 1) % batch_size == 0
-        is_last_batch = i == len(documents) - 1
-        if is_full_batch or is_last_batch:
-            batches_of_actions.append(actions.copy())
-            actions = []
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_batch_write = {
-            executor.submit(_bulk_index, actions)
-            for actions in batches_of_actions
-        }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BULK_MAX_WORKERS) as executor:
         with timed_operation(
-            "elasticsearch",
+            data_store,
             "basic_write",
-            num_records=len(documents)
-        ):
-            for future in concurrent.futures.as_completed(future_to_batch_write):
-                try:
-                    future.result()
-                except Exception as exc:
-                    raise exc
+            num_records=len(documents),
+            reuse_connections=reuse_connections,
+            compress_requests=compress_requests,
+        ) as timer:
+            result = BulkResult()
+
+            def _collect(futures):
+                for future in futures:
+                    result.merge(future.result())
+
+            # Only one body per worker is in flight, plus the one being
+            # encoded, so at most (BULK_MAX_WORKERS + 1) * max_bytes of bodies
+            # are held in memory at a time
+            pending = set()
+            bodies = _bulk_bodies(index, documents, doc_ids, max_bytes)
+            while True:
+                with timer.phase("serialize"):
+                    body, _ = next(bodies, (None, 0))
+                if body is None:
+                    break
+                if len(pending) >= BULK_MAX_WORKERS:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    _collect(done)
+                pending.add(executor.submit(_bulk_index, body))
+            _collect(concurrent.futures.as_completed(pending))
+
+            timer.attributes["raw_bytes"] = result.raw_bytes
+            timer.attributes["sent_bytes"] = result.sent_bytes
+            timer.attributes["retried_docs"] = result.retried_docs
+            timer.attributes["dropped_docs"] = result.dropped_docs
+            timer.add_phase("serialize", result.compress_ns)
+            timer.add_phase("send", result.send_ns)
+            timer.add_phase("server", result.server_took_ms * 1_000_000)
 
 
 def get_document(index: str, doc_id: str) -> dict:
-    resp = requests.get(
+    resp = http.get(
         f"{elastic_url}{index}/_doc/{doc_id}",
         auth=auth,
     )
@@ -142,7 +373,7 @@ def get_documents_in_bulk(index: str, doc_ids: List[str]) -> List[dict]:
     json_payload = {
         "ids": doc_ids
     }
-    resp = requests.get(
+    resp = http.get(
         f"{elastic_url}{index}/_mget",
         auth=auth,
         headers=ES_CONTENT_HEADERS,
@@ -154,10 +385,136 @@ def get_documents_in_bulk(index: str, doc_ids: List[str]) -> List[dict]:
 
 def query(index: str, query: dict) -> List[dict]:
     request_url = f"{elastic_url}{index}/_search"
-    resp = requests.get(request_url, auth=auth, json=query)
+    resp = http.get(request_url, auth=auth, json=query)
     return _check_response(resp, "query")
 
 
+def aggregate_all(
+    index: str,
+    search_query: dict,
+    stats: AggregationStats = None,
+    max_buckets: int = None
+) -> Iterator[dict]:
+    """
+    Yields every bucket of the composite aggregation in `query`, requesting
+    page after page (following `after_key`) until the buckets run out.
+
+    Args:
+        index (str): index or alias to query
+        search_query (dict): search body with one top-level composite aggregation.
+            It is not modified.
+        stats (AggregationStats, optional): filled in with the number of
+            pages fetched and buckets yielded
+        max_buckets (int, optional): stop after this many buckets (the
+            equivalent of a LIMIT), requesting no more than are needed
+    """
+    aggs_key = "aggs" if "aggs" in search_query else "aggregations"
+    agg_name, agg = next(
+        (name, body)
+        for name, body in search_query[aggs_key].items()
+        if "composite" in body
+    )
+    after_key = None
+    num_buckets = 0
+    while True:
+        composite = dict(agg["composite"])
+        if max_buckets is not None:
+            composite["size"] = min(composite.get("size", 10), max_buckets - num_buckets)
+        if after_key is not None:
+            composite["after"] = after_key
+        page_query = {
+            **search_query,
+            aggs_key: {
+                **search_query[aggs_key],
+                agg_name: {**agg, "composite": composite}
+            },
+        }
+        request_start = time.perf_counter_ns()
+        result = query(index, page_query)
+        if stats is not None:
+            stats.request_ns += time.perf_counter_ns() - request_start
+            stats.server_took_ms += result.get("took", 0)
+        agg_result = (result.get("aggregations") or {}).get(agg_name) or {}
+        buckets = agg_result.get("buckets", [])
+        if stats is not None:
+            stats.pages += 1
+            stats.buckets += len(buckets)
+        for bucket in buckets:
+            yield bucket
+        num_buckets += len(buckets)
+
+        after_key = agg_result.get("after_key")
+        if len(buckets) == 0 or after_key is None:
+            return
+        if max_buckets is not None and num_buckets >= max_buckets:
+            return
+
+
+def iter_document_pages(
+    index: str,
+    query: dict,
+    sort_by: List[dict] = None,
+    source_fields_to_fetch: List[str] = None,
+    filter_fn: Callable = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    prefetch: bool = False,
+    tiebreaker: List[dict] = None,
+) -> Iterator[List[dict]]:
+    """
+    Iterates over every document matching `query`, a page at a time, using
+    `search_after`. At most the current page (and, with `prefetch`, the next
+    one being fetched on a background thread) is held in memory.
+
+    The domain runs Elasticsearch 7.10 OSS, which has neither point-in-time
+    nor the `_shard_doc` sort, so pages are not a consistent snapshot and
+    sort positions are made unique by the `tiebreaker` fields (time and
+    job_id by default) instead.
+
+    Yields:
+        list: hits of the next page (after `filter_fn`, if given)
+    """
+    sort = list(sort_by or []) + list(tiebreaker or SEARCH_AFTER_TIEBREAKER)
+
+    def _fetch_page(_search_after: list = None) -> dict:
+        payload = {
+            "size": page_size,
+            "query": query,
+            "sort": sort,
+        }
+        if source_fields_to_fetch is not None:
+            payload["_source"] = source_fields_to_fetch
+        if _search_after is not None:
+            payload["search_after"] = _search_after
+        _resp = http.post(f"{elastic_url}{index}/_search", auth=auth, json=payload)
+        return _check_response(_resp, "iter_document_pages:_fetch_page")
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        results = _fetch_page()
+        while True:
+            hits = (results.get("hits") or {}).get("hits", [])
+            if len(hits) == 0:
+                return
+
+            next_page = None
+            if len(hits) == page_size:
+                if executor is not None:
+                    next_page = executor.submit(_fetch_page, hits[-1]["sort"])
+                else:
+                    next_page = functools.partial(_fetch_page, hits[-1]["sort"])
+
+            if filter_fn:
+                hits = [document for document in hits if filter_fn(document)]
+            yield hits
+
+            if next_page is None:
+                return
+            results = next_page.result() if executor is not None else next_page()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
 def query_documents(
     index: str,
     query: dict,
@@ -165,106 +522,154 @@ def query_documents(
     source_fields_to_fetch: List[str] = None,
     filter_fn: Callable = None
 ) -> List[dict]:
-    def _fetch_page(_scroll_id: str = None) -> dict:
-        if _scroll_id is None:
-            payload = {
-                "size": DEFAULT_PAGE_SIZE,
-                "query": query,
-            }
-            if sort_by is not None:
-                payload["sort"] = sort_by
-            if source_fields_to_fetch is not None:
-                payload["_source"] = source_fields_to_fetch
-            request_url = f"{elastic_url}{index}/_search?scroll=1m"
-        else:
-            payload = {
-                "scroll": "5s",
-                "scroll_id": _scroll_id
-            }
-            request_url = f"{elastic_url}_search/scroll"
+    all_hits = []
+    for hits in iter_document_pages(
+        index,
+        query,
+        sort_by=sort_by,
+        source_fields_to_fetch=source_fields_to_fetch,
+        filter_fn=filter_fn,
+    ):
+        all_hits.extend(hits)
+    return all_hits
 
-        resp = requests.get(request_url, auth=auth, json=payload)
-        return _check_response(resp, "query_documents:_fetch_page")
 
-    def _hits_from_results(_results) -> List[dict]:
-        return (_results.get("hits") or {}).get("hits", [])
+def _send_bulk(body: bytes, result: BulkResult) -> requests.Response:
+    headers = ES_BULK_HEADERS
+    if compress_requests:
+        headers = {**ES_BULK_HEADERS, "Content-Encoding": "gzip"}
+        compress_start = time.perf_counter_ns()
+        body = gzip.compress(body, compresslevel=1)
+        result.compress_ns += time.perf_counter_ns() - compress_start
+    send_start = time.perf_counter_ns()
+    resp = http.put(f"{elastic_url}_bulk", auth=auth, headers=headers, data=body)
+    result.send_ns += time.perf_counter_ns() - send_start
+    result.sent_bytes += len(body)
+    return resp
 
-    results = _fetch_page()
-    hits = _hits_from_results(results)
-    all_hits = []
-    scroll_ids = []
-    while len(hits) > 0:
-        if filter_fn:
-            hits = [document for document in hits if filter_fn(document)]
-        all_hits.extend(hits)
 
-        scroll_id = results.get("_scroll_id")
-        if scroll_id:
-            scroll_ids.append(scroll_id)
+def _retry_delay(attempt: int) -> float:
+    # Exponential backoff with full jitter, so that workers throttled together
+    # do not all come back at the same moment
+    return random.uniform(0, min(BULK_RETRY_MAX_DELAY, BULK_RETRY_BASE_DELAY * 2 ** attempt))
 
-        results = _fetch_page(scroll_id)
-        hits = _hits_from_results(results)
 
-    # Clear scroll contexts
-    requests.delete(
-        f"{elastic_url}_search/scroll", json={
-            "scroll_id": scroll_ids
-        }
-    )
+def _split_bulk_body(body: bytes) -> Tuple[bytes, bytes]:
+    lines = body.split(b"\n")[:-1]
+    mid = len(lines) // 2
+    # ensure mid is always even, since lines are in pairs of action/document
+    mid = mid + 1 if mid % 2 == 1 else mid
+    return b"\n".join(lines[:mid]) + b"\n", b"\n".join(lines[mid:]) + b"\n"
 
-    return all_hits
 
+def _rejected_items(body: bytes, response_data: dict) -> Tuple[bytes, int, list]:
+    """
+    Picks the documents of a bulk response that were rejected with a
+    retryable status out of the request body.
 
-def _bulk_index(actions: List[str], start=0, end=None, backoff=1):
+    Returns:
+        tuple: body to resend, number of documents in it and the errors of
+            documents that cannot be retried
     """
-    This function sends bulk_index request to Elasticsearch and also handles
+    lines = body.split(b"\n")
+    retry_body = bytearray()
+    num_retried = 0
+    errors = []
+    for i, item in enumerate(response_data.get("items", [])):
+        item_result = next(iter(item.values()), None) or {}
+        status = item_result.get("status", HTTPStatus.OK)
+        if status < 300:
+            continue
+        if status in RETRYABLE_STATUSES:
+            retry_body += lines[2 * i] + b"\n" + lines[2 * i + 1] + b"\n"
+            num_retried += 1
+        else:
+            errors.append(item_result.get("error"))
+    return bytes(retry_body), num_retried, errors
+
+
+def _bulk_index(body: bytes) -> BulkResult:
+    """
+    This function sends bulk_index request to Elasticsearch. Documents
+    rejected with a retryable status (the whole request or single items) are
+    resent with jittered backoff until `BULK_MAX_RETRIES` is spent; documents
+    rejected for any other reason are dropped and logged. It also handles
     `RequestPayload` too large error.
 
     Args:
-        actions (list): Elasticsearch bulk index documents
-        start (int, optional): payload slice start. Defaults to 0.
-        end (int, optional): payload slice end. Defaults to None.
+        body (bytes): NDJSON bulk body (action and document line pairs)
 
     Returns:
-        int: batch size to be used in next requests
+        BulkResult: payload bytes and retried/dropped document counts
     """
-    end = end or len(actions)
-    batch_size = end - start
-    resp = requests.put(
-        f"{elastic_url}_bulk",
-        auth=auth,
-        headers=ES_CONTENT_HEADERS,
-        data=('\n'.join(actions[start:end]) + '\n').encode()
-    )
-    if resp.status_code == 413:
-        mid = (start + end) // 2
-        # ensure mid is always even, since actions are in batches of 2
-        mid = mid + 1 if mid % 2 == 1 else mid
-        batch_size = min(_bulk_index(actions, start, mid), batch_size)
-        batch_size = max(_bulk_index(actions, mid, end), batch_size)
-    elif (
-        resp.status_code == HTTPStatus.TOO_MANY_REQUESTS
-        or resp.status_code == HTTPStatus.GATEWAY_TIMEOUT
-    ):
-        if backoff > 60:
-            _check_response(resp, "_bulk_index")
+    result = BulkResult()
+    attempt = 0
+    while True:
+        resp = _send_bulk(body, result)
+        result.raw_bytes += len(body)
+
+        if resp.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE:
+            if body.count(b"\n") <= 2:
+                # A single document over the request limit cannot be split
+                result.dropped_docs += 1
+                log.warning(
+                    {
+                        "message": "Dropped document larger than the bulk request limit",
+                        "num_bytes": len(body)
+                    }
+                )
+                return result
+            for half in _split_bulk_body(body):
+                result.merge(_bulk_index(half))
+            return result
+        if resp.status_code in RETRYABLE_STATUSES:
+            retry_body, num_retried = body, body.count(b"\n") // 2
+        elif resp.status_code in (HTTPStatus.OK, HTTPStatus.CREATED):
+            response_data = resp.json()
+            result.server_took_ms += response_data.get("took", 0)
+            if not response_data.get("errors"):
+                return result
+            retry_body, num_retried, errors = _rejected_items(body, response_data)
+            if errors:
+                result.dropped_docs += len(errors)
+                log.warning(
+                    {
+                        "message": "Dropped documents rejected by bulk index",
+                        "num_documents": len(errors),
+                        "error_data": errors[:10]
+                    }
+                )
         else:
-            time.sleep(backoff)
-            _bulk_index(actions, start, end, backoff=(backoff * 2))
-    else:
-        _check_response(resp, "_bulk_index")
-    return batch_size
+            _check_response(resp, "_bulk_index")
+            return result
+
+        if num_retried == 0:
+            return result
+        if attempt >= BULK_MAX_RETRIES:
+            result.dropped_docs += num_retried
+            log.warning(
+                {
+                    "message": "Bulk index retries exhausted",
+                    "num_documents": num_retried,
+                    "status_code": resp.status_code
+                }
+            )
+            return result
+        attempt += 1
+        result.retried_docs += num_retried
+        time.sleep(_retry_delay(attempt))
+        body = retry_body
 
 
 def index_exists(index_name):
     index_url = elastic_url + index_name
-    resp = requests.head(index_url, auth=auth)
+    resp = http.head(index_url, auth=auth)
     return not resp.status_code == HTTPStatus.NOT_FOUND
 
 
 def delete_index(index_name):
     index_url = elastic_url + index_name
-    resp = requests.delete(index_url, auth=auth)
+    resp = http.delete(index_url, auth=auth)
     _check_response(resp, "delete_index", err_title=f"{index_name} deletion failed")
     return resp
 
@@ -281,7 +686,7 @@ def reindex(source_index, destination_index, fields_list=None):
     if fields_list:
         payload["source"]["_source"] = fields_list
     index_url = elastic_url + "_reindex"
-    resp = requests.post(index_url, auth=auth, json=payload)
+    resp = http.post(index_url, auth=auth, json=payload)
     _check_response(
         resp,
         "reindex",
@@ -291,7 +696,7 @@ def reindex(source_index, destination_index, fields_list=None):
 
 
 def refresh_index(index_name):
-    resp = requests.post(elastic_url + f"{index_name}/_refresh", auth=auth)
+    resp = http.post(elastic_url + f"{index_name}/_refresh", auth=auth)
     _check_response(
         resp,
         "refresh_index",
@@ -300,8 +705,144 @@ def refresh_index(index_name):
     return resp
 
 
+def get_index_settings(index: str) -> dict:
+    resp = http.get(f"{elastic_url}{index}/_settings?flat_settings=true", auth=auth)
+    result = _check_response(resp, "get_index_settings")
+    return {
+        concrete_index: index_data.get("settings", {})
+        for concrete_index, index_data in result.items()
+    }
+
+
+def update_index_settings(index: str, settings: dict):
+    """
+    Updates dynamic settings of `index`. Settings set to None are reset to
+    their defaults.
+    """
+    resp = http.put(f"{elastic_url}{index}/_settings", auth=auth, json=settings)
+    _check_response(
+        resp,
+        "update_index_settings",
+        err_title=f"{index} settings update failed"
+    )
+
+
+def _get_index_meta(index: str) -> dict:
+    resp = http.get(f"{elastic_url}{index}/_mapping", auth=auth)
+    result = _check_response(resp, "_get_index_meta")
+    return {
+        concrete_index: (index_data.get("mappings") or {}).get("_meta") or {}
+        for concrete_index, index_data in result.items()
+    }
+
+
+def _put_index_meta(index: str, meta: dict):
+    resp = http.put(f"{elastic_url}{index}/_mapping", auth=auth, json={"_meta": meta})
+    _check_response(resp, "_put_index_meta")
+
+
+def restore_ingest_mode_settings(index: str) -> List[str]:
+    """
+    Restores the settings that `ingest_mode` saved in the `_meta` of
+    `index`'s concrete indices and never got to restore (the run died inside
+    the block), so that an index is not left tuned for ingestion once the
+    toggle is off.
+
+    Returns:
+        list: concrete indices whose settings were restored
+    """
+    restored = []
+    for concrete_index, meta in _get_index_meta(index).items():
+        if INGEST_MODE_META_KEY not in meta:
+            continue
+        update_index_settings(concrete_index, meta[INGEST_MODE_META_KEY])
+        meta = dict(meta)
+        meta.pop(INGEST_MODE_META_KEY)
+        _put_index_meta(concrete_index, meta)
+        restored.append(concrete_index)
+    if restored:
+        log.warning(
+            {
+                "message": "Restored settings left behind by ingest mode",
+                "indices": restored
+            }
+        )
+        refresh_index(index)
+    return restored
+
+
+@contextmanager
+def ingest_mode(index: str, drop_replicas=False, async_translog=False):
+    """
+    Tunes `index` for bulk ingestion for the duration of the block: refreshes
+    are turned off, and optionally replicas are dropped and the translog is
+    made asynchronous. On exit the previous settings are restored and the
+    index is refreshed once.
+
+    The previous settings are saved in the index mapping's `_meta` before
+    anything is changed, so that if a run dies inside the block, the next
+    one restores the original settings rather than the tuned ones.
+    """
+    tuned_settings = {"index.refresh_interval": "-1"}
+    if drop_replicas:
+        tuned_settings["index.number_of_replicas"] = 0
+    if async_translog:
+        tuned_settings["index.translog.durability"] = "async"
+
+    saved_settings = {}
+    index_meta = _get_index_meta(index)
+    for concrete_index, settings in get_index_settings(index).items():
+        meta = index_meta.get(concrete_index, {})
+        if INGEST_MODE_META_KEY in meta:
+            # Left behind by a run that did not get to restore them
+            saved_settings[concrete_index] = meta[INGEST_MODE_META_KEY]
+            continue
+        saved_settings[concrete_index] = {
+            name: settings.get(name) for name in tuned_settings
+        }
+        _put_index_meta(
+            concrete_index,
+            {**meta, INGEST_MODE_META_KEY: saved_settings[concrete_index]}
+        )
+
+    try:
+        update_index_settings(index, tuned_settings)
+        yield
+    finally:
+        for concrete_index, settings in saved_settings.items():
+            update_index_settings(concrete_index, settings)
+            meta = dict(index_meta.get(concrete_index, {}))
+            meta.pop(INGEST_MODE_META_KEY, None)
+            _put_index_meta(concrete_index, meta)
+        refresh_index(index)
+
+
+def count(index: str, query: dict) -> int:
+    resp = http.post(f"{elastic_url}{index}/_count", auth=auth, json={"query": query})
+    return _check_response(resp, "count").get("count", 0)
+
+
+def wait_until_searchable(
+    index: str,
+    query: dict,
+    expected_count: int = 1,
+    timeout: float = 30,
+    poll_interval: float = 0.05
+) -> bool:
+    """
+    Polls `index` until `query` matches at least `expected_count` documents,
+    or `timeout` seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    while count(index, query) < expected_count:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(poll_interval)
+    return True
+
+
 def get_all_indices_request():
-    resp = requests.get(
+    resp = http.get(
         f"{elastic_url}_cat/indices?bytes=b&s=index&format=json",
         auth=auth
     )
@@ -1,15 +1,15 @@
-import uuid
+import string
+import threading
 import random
 from dataclasses import dataclass
 from enum import Enum
 from random import choice
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
 
-from faker import Faker
+import numpy as np
 
 from src.helpers import get_unix_timestamp, get_unix_timestamp_ms, DataType
 
-fake = Faker()
-Faker.seed(0)
 org_ids = ("1", "2")
 user_ids_for_org_id = {
     "1": (
@@ -29,6 +29,7 @@ failure_rates = (0.0, 0.0001, 0.01)
 repo_ids = ("16311212173", "16554252419", "16629121578")
 priorities = ("HIGH", "MEDIUM", "LOW")
 job_types = ("ADD", "UPDATE", "DELETE")
+rng = np.random.default_rng()
 
 
 class IngestionJobStage(int, Enum):
@@ -77,77 +78,166 @@ class IngestionBatch:
     created_at: int
 
 
-class IngestionEvent:
+event_field_types = {
+    "ingestion_batch_id": DataType.STRING,
+    "org_id": DataType.STRING,
+    "user_id": DataType.STRING,
+    "repo_id": DataType.STRING,
+    "repo_version": DataType.STRING,
+    "priority": DataType.STRING,
+    "job_id": DataType.STRING,
+    "job_type": DataType.STRING,
+    "created_at": DataType.TIMESTAMP,
+    "dataset_id": DataType.STRING,
+    "num_stages": DataType.INTEGER,
+    "time": DataType.TIMESTAMP,
+    "stage": DataType.STRING,
+    "stage_progress": DataType.INTEGER,
+    "errored": DataType.BOOLEAN,
+    "finished": DataType.BOOLEAN,
+}
+event_fields = tuple(event_field_types)
+_stage_names = np.array([str(stage) for stage in IngestionJobStage])
+_job_types = np.array(job_types)
+_hex_chars = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+_dataset_id_chars = np.frombuffer(string.ascii_uppercase.encode(), dtype=np.uint8)
+
+
+def _generate_job_ids(num_jobs: int) -> np.ndarray:
+    raw = rng.integers(0, 256, size=(num_jobs, 16), dtype=np.uint8)
+    # Stamp the version (4) and variant bits the same way uuid.uuid4() does
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+
+    hex_digits = np.empty((num_jobs, 32), dtype=np.uint8)
+    hex_digits[:, 0::2] = _hex_chars[raw >> 4]
+    hex_digits[:, 1::2] = _hex_chars[raw & 0x0F]
+
+    chars = np.full((num_jobs, 36), ord("-"), dtype=np.uint8)
+    chars[:, 0:8] = hex_digits[:, 0:8]
+    chars[:, 9:13] = hex_digits[:, 8:12]
+    chars[:, 14:18] = hex_digits[:, 12:16]
+    chars[:, 19:23] = hex_digits[:, 16:20]
+    chars[:, 24:36] = hex_digits[:, 20:32]
+    return chars.view("S36").ravel().astype("U36")
+
+
+def _generate_dataset_ids(num_jobs: int) -> np.ndarray:
+    chars = _dataset_id_chars[rng.integers(0, 26, size=(num_jobs, 11))]
+    chars[:, 6] = ord("_")
+    return chars.view("S11").ravel().astype("U11")
+
+
+class EventBatch:
+    """
+    Array-backed state of every job in an ingestion batch.
+
+    Job attributes are generated in bulk and all jobs are advanced through
+    their stages in a single vectorized step. Dicts and rows are only built
+    when a store adapter asks for them, and only for the jobs that are still
+    active (a job that errors is written once with `errored` set and then
+    dropped from later waves).
+
+    The columns, dicts and rows handed out for a wave are shared between
+    callers and must be treated as read-only.
+    """
 
     def __init__(self, ingestion_batch: IngestionBatch):
+        num_jobs = ingestion_batch.num_jobs
         self.ingestion_batch = ingestion_batch
-        self.job_id = str(uuid.uuid4())
-        self.job_type = choice(job_types)
-        self.dataset_id = f"{fake.pystr(6, 6).upper()}_{fake.pystr(4, 4).upper()}"
         self.num_stages = IngestionJobStage.FINISHED.stage_num()
-        self.time = get_unix_timestamp_ms()
-        self.stage = IngestionJobStage.IN_QUEUE
-        self.stage_progress = self.stage.value
-        self.errored = False
-        self.finished = False
+        self.job_ids = _generate_job_ids(num_jobs)
+        self.job_types = _job_types[rng.integers(0, len(job_types), size=num_jobs)]
+        self.dataset_ids = _generate_dataset_ids(num_jobs)
+        self.time = np.full(num_jobs, get_unix_timestamp_ms(), dtype=np.int64)
+        self.stage = np.full(num_jobs, IngestionJobStage.IN_QUEUE.value, dtype=np.int8)
+        self.errored = np.zeros(num_jobs, dtype=bool)
+        self.finished = np.zeros(num_jobs, dtype=bool)
+        self.active = np.ones(num_jobs, dtype=bool)
 
-    def as_dict(self):
-        return {
-            "ingestion_batch_id": self.ingestion_batch.batch_id,
-            "org_id": self.ingestion_batch.org_id,
-            "user_id": self.ingestion_batch.user_id,
-            "repo_id": self.ingestion_batch.repo_id,
-            "repo_version": self.ingestion_batch.repo_version,
-            "priority": self.ingestion_batch.priority,
-            "job_id": self.job_id,
-            "job_type": self.job_type,
-            "created_at": self.ingestion_batch.created_at,
-            "dataset_id": self.dataset_id,
-            "num_stages": self.num_stages,
-            "time": self.time,
-            "stage": str(self.stage),
-            "stage_progress": self.stage_progress,
-            "errored": self.errored,
-            "finished": self.finished,
-        }
+        self._lock = threading.Lock()
+        self._columns = None
+        self._dicts = None
+
+    @staticmethod
+    def get_types_for_event_fields() -> Dict[str, DataType]:
+        return event_field_types.copy()
+
+    @property
+    def num_jobs(self) -> int:
+        return len(self.job_ids)
+
+    @property
+    def num_active_jobs(self) -> int:
+        return int(np.count_nonzero(self.active))
 
     def transition_to_next_stage(self):
-        self.time = get_unix_timestamp_ms()
-        self.stage = self.stage.next_stage()
-        self.stage_progress = self.stage.value
-        if self.stage != IngestionJobStage.FINISHED:
-            self.errored = (random.random() < self.ingestion_batch.job_failure_rate)
-        else:
-            self.finished = True
+        self.active &= ~self.errored
 
-    @staticmethod
-    def get_types_for_event_fields():
-        field_types = {
-            "ingestion_batch_id": DataType.STRING,
-            "org_id": DataType.STRING,
-            "user_id": DataType.STRING,
-            "repo_id": DataType.STRING,
-            "repo_version": DataType.STRING,
-            "priority": DataType.STRING,
-            "job_id": DataType.STRING,
-            "job_type": DataType.STRING,
-            "created_at": DataType.TIMESTAMP,
-            "dataset_id": DataType.STRING,
-            "num_stages": DataType.INTEGER,
-            "time": DataType.TIMESTAMP,
-            "stage": DataType.STRING,
-            "stage_progress": DataType.INTEGER,
-            "errored": DataType.BOOLEAN,
-            "finished": DataType.BOOLEAN,
+        self.time[self.active] = get_unix_timestamp_ms()
+        self.stage[self.active] = np.minimum(
+            self.stage[self.active] + 1,
+            IngestionJobStage.FINISHED
+        )
+        is_finished = self.stage == IngestionJobStage.FINISHED
+        in_progress = self.active & ~is_finished
+        failure_draws = rng.random(self.num_jobs)
+        self.errored[in_progress] = (
+            failure_draws[in_progress] < self.ingestion_batch.job_failure_rate
+        )
+        self.finished[self.active & is_finished] = True
+
+        with self._lock:
+            self._columns = None
+            self._dicts = None
+
+    def _build_columns(self) -> Dict[str, list]:
+        batch = self.ingestion_batch
+        active = self.active
+        num_active = self.num_active_jobs
+        stages = self.stage[active]
+        return {
+            "ingestion_batch_id": [batch.batch_id] * num_active,
+            "org_id": [batch.org_id] * num_active,
+            "user_id": [batch.user_id] * num_active,
+            "repo_id": [batch.repo_id] * num_active,
+            "repo_version": [batch.repo_version] * num_active,
+            "priority": [batch.priority] * num_active,
+            "job_id": self.job_ids[active].tolist(),
+            "job_type": self.job_types[active].tolist(),
+            "created_at": [batch.created_at] * num_active,
+            "dataset_id": self.dataset_ids[active].tolist(),
+            "num_stages": [self.num_stages] * num_active,
+            "time": self.time[active].tolist(),
+            "stage": _stage_names[stages].tolist(),
+            "stage_progress": stages.tolist(),
+            "errored": self.errored[active].tolist(),
+            "finished": self.finished[active].tolist(),
         }
-        return field_types.copy()
+
+    def columns(self) -> Dict[str, list]:
+        with self._lock:
+            if self._columns is None:
+                self._columns = self._build_columns()
+            return self._columns
+
+    def rows(self, fields: Sequence[str] = event_fields) -> Iterator[Tuple[Any, ...]]:
+        columns = self.columns()
+        return zip(*(columns[field] for field in fields))
+
+    def as_dicts(self) -> List[Dict[str, Any]]:
+        columns = self.columns()
+        with self._lock:
+            if self._dicts is None:
+                self._dicts = [
+                    dict(zip(event_fields, row))
+                    for row in zip(*(columns[field] for field in event_fields))
+                ]
+            return self._dicts
 
 
-def generate_ingestion_job_events(ingestion_batch: IngestionBatch):
-    job_events = []
-    for _ in range(ingestion_batch.num_jobs):
-        job_events.append(IngestionEvent(ingestion_batch))
-    return job_events
+def generate_event_batch(ingestion_batch: IngestionBatch) -> EventBatch:
+    return EventBatch(ingestion_batch)
 
 
 def generate_ingestion_batch_pair(min_num_jobs, max_num_jobs):
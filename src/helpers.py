@@ -1,12 +1,16 @@
-import os
+import threading
 import time
-from contextlib import ContextDecorator
+import uuid
+from contextlib import ContextDecorator, contextmanager
 from datetime import datetime, timedelta
 from enum import Enum
 
 import boto3
 from requests_aws4auth import AWS4Auth
 
+from src.histograms import latency_histograms
+from src.results import get_result_sink
+
 
 def get_unix_timestamp():
     return int(time.time())
@@ -41,6 +45,12 @@ def create_batches_from_list(list_of_items: list, batch_size: int = 100):
     ]
 
 
+def new_record_id() -> str:
+    # Records can be created in the same millisecond on different threads, so
+    # the id also carries a random part
+    return f"{get_unix_timestamp_ms()}-{uuid.uuid4().hex}"
+
+
 def get_awsauth(region, service):
     credentials = boto3.Session().get_credentials()
     awsauth = AWS4Auth(
@@ -65,32 +75,107 @@ class DataType(str, Enum):
 
 
 class timed_operation(ContextDecorator):
-    def __init__(self, data_store, operation, num_records=None, is_first_query=None):
-        self.record_id = str(get_unix_timestamp_ms())
+    """
+    Times the wrapped block with `perf_counter_ns` and records it, along with
+    the durations of any named phases inside it (e.g. serialize, send,
+    server, decode). Phase durations are cumulative, so phases timed on
+    several threads at once can add up to more than the operation itself.
+    """
+
+    def __init__(
+        self,
+        data_store,
+        operation,
+        num_records=None,
+        is_first_query=None,
+        **attributes
+    ):
+        self.record_id = new_record_id()
         self.data_store = data_store
         self.operation = operation
         self.num_records = num_records
         self.is_first_query = is_first_query
-        self.start_time = -1
-        self.end_time = -1
-        self._table = boto3.resource("dynamodb").Table(
-            os.getenv("BENCHMARK_DATA_TABLE_NAME")
-        )
+        # Extra fields stored with the record (skipped when None)
+        self.attributes = attributes
+        self.phases_ns = {}
+        self._phases_lock = threading.Lock()
+        self.start_time_ns = -1
+        self.end_time_ns = -1
+
+    def add_phase(self, name: str, duration_ns: int):
+        with self._phases_lock:
+            self.phases_ns[name] = self.phases_ns.get(name, 0) + int(duration_ns)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter_ns() - start)
 
     def __enter__(self):
-        self.start_time = get_unix_timestamp_ms()
+        self.start_time_ns = time.perf_counter_ns()
+        return self
 
     def __exit__(self, exc_type, exc, exc_tb):
-        self.end_time = get_unix_timestamp_ms()
+        self.end_time_ns = time.perf_counter_ns()
         if not exc:
+            exec_time_ns = self.end_time_ns - self.start_time_ns
             item = {
                 "record_id": self.record_id,
                 "data_store": self.data_store,
                 "operation": self.operation,
-                "exec_time": self.end_time - self.start_time,
+                # In ms, as before, but no longer rounded to whole ms
+                "exec_time": round(exec_time_ns / 1e6, 3),
+                "exec_time_ns": exec_time_ns,
             }
             if self.num_records is not None:
                 item["num_records"] = self.num_records
             if self.is_first_query is not None:
                 item["is_first_query"] = self.is_first_query
-            self._table.put_item(Item=item)
+            if self.phases_ns:
+                item["phase_times"] = {
+                    name: round(duration_ns / 1e6, 3)
+                    for name, duration_ns in self.phases_ns.items()
+                }
+            for name, value in self.attributes.items():
+                if value is not None:
+                    item[name] = value
+            get_result_sink().record(item)
+            latency_histograms.record(
+                self.data_store,
+                self.operation,
+                exec_time_ns,
+                scale=self.attributes.get("scale"),
+                # Wall clock, so that spans of several processes can merge
+                start_ns=time.time_ns() - exec_time_ns,
+                num_records=self.num_records,
+            )
+
+
+def record_latency_summaries():
+    """
+    Prints and records a latency summary (percentiles, count, throughput)
+    per (data_store, operation, scale) timed since the last call. Each
+    summary row also carries its histogram, so that rows of several
+    invocations can be merged later with `LatencyHistogram.from_dict`.
+    """
+    for (data_store, operation, scale), histogram in sorted(
+        latency_histograms.drain().items(),
+        key=lambda entry: tuple(str(part) for part in entry[0])
+    ):
+        summary = histogram.summary()
+        print(f"{data_store} {operation} {scale or ''}: {summary}")
+        item = {
+            "record_id": new_record_id(),
+            "data_store": data_store,
+            "operation": "latency_summary",
+            "summarized_operation": operation,
+            "scale": scale,
+            "histogram": histogram.to_dict(),
+            **summary,
+        }
+        get_result_sink().record(
+            {name: value for name, value in item.items() if value is not None}
+        )
@@ -0,0 +1,165 @@
+import math
+import threading
+from typing import Dict, Optional, Tuple
+
+# Buckets grow geometrically, so every recorded value is reported within
+# this relative error whatever its magnitude
+histogram_precision = 0.01
+summary_percentiles = (50, 90, 99, 99.9)
+
+_log_base = math.log1p(histogram_precision)
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed latency histogram (in the spirit of HdrHistogram). Bucket
+    `i` holds values in [(1 + precision) ** i, (1 + precision) ** (i + 1)),
+    and buckets are kept sparsely, so histograms recorded on different
+    threads or in different invocations merge by adding their counts.
+    """
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.num_records = 0
+        self.min_ns: Optional[int] = None
+        self.max_ns: Optional[int] = None
+        # Span over which the samples were taken, for throughput
+        self.first_start_ns: Optional[int] = None
+        self.last_end_ns: Optional[int] = None
+
+    def record(self, value_ns: int, start_ns: int = None, num_records: int = None):
+        bucket = int(math.log(max(value_ns, 1)) / _log_base)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.num_records += num_records or 0
+        self.min_ns = value_ns if self.min_ns is None else min(self.min_ns, value_ns)
+        self.max_ns = value_ns if self.max_ns is None else max(self.max_ns, value_ns)
+        if start_ns is not None:
+            end_ns = start_ns + value_ns
+            if self.first_start_ns is None or start_ns < self.first_start_ns:
+                self.first_start_ns = start_ns
+            if self.last_end_ns is None or end_ns > self.last_end_ns:
+                self.last_end_ns = end_ns
+
+    def merge(self, other: "LatencyHistogram"):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.num_records += other.num_records
+        for name, pick in (
+            ("min_ns", min),
+            ("max_ns", max),
+            ("first_start_ns", min),
+            ("last_end_ns", max),
+        ):
+            values = [v for v in (getattr(self, name), getattr(other, name)) if v is not None]
+            setattr(self, name, pick(values) if values else None)
+
+    def percentile(self, percentile: float) -> Optional[int]:
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                # Geometric middle of the bucket, kept within what was seen
+                value = int(math.exp((bucket + 0.5) * _log_base))
+                return min(max(value, self.min_ns), self.max_ns)
+        return self.max_ns
+
+    @property
+    def elapsed_seconds(self) -> Optional[float]:
+        if self.first_start_ns is None or self.last_end_ns <= self.first_start_ns:
+            return None
+        return (self.last_end_ns - self.first_start_ns) / 1e9
+
+    def summary(self) -> dict:
+        """
+        Percentiles (in ms), count and throughput of the recorded values.
+        """
+        summary = {
+            "count": self.count,
+            "min": round(self.min_ns / 1e6, 3) if self.count else None,
+            "max": round(self.max_ns / 1e6, 3) if self.count else None,
+        }
+        for percentile in summary_percentiles:
+            value = self.percentile(percentile)
+            name = f"p{percentile:g}".replace(".", "_")
+            summary[name] = round(value / 1e6, 3) if value is not None else None
+        elapsed = self.elapsed_seconds
+        if elapsed:
+            summary["ops_per_sec"] = round(self.count / elapsed, 3)
+            if self.num_records:
+                summary["records_per_sec"] = round(self.num_records / elapsed, 3)
+        return summary
+
+    def to_dict(self) -> dict:
+        return {
+            "counts": {str(bucket): count for bucket, count in self.counts.items()},
+            "count": self.count,
+            "num_records": self.num_records,
+            "min_ns": self.min_ns,
+            "max_ns": self.max_ns,
+            "first_start_ns": self.first_start_ns,
+            "last_end_ns": self.last_end_ns,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        histogram = cls()
+        histogram.counts = {int(bucket): int(count) for bucket, count in data["counts"].items()}
+        for name in (
+            "count",
+            "num_records",
+            "min_ns",
+            "max_ns",
+            "first_start_ns",
+            "last_end_ns",
+        ):
+            value = data.get(name)
+            setattr(histogram, name, int(value) if value is not None else None)
+        return histogram
+
+
+HistogramKey = Tuple[str, str, Optional[str]]
+
+
+class HistogramRegistry:
+    """
+    Latency histograms keyed by (data_store, operation, scale), shared by all
+    the threads of a process.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[HistogramKey, LatencyHistogram] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        data_store: str,
+        operation: str,
+        value_ns: int,
+        scale: str = None,
+        start_ns: int = None,
+        num_records: int = None
+    ):
+        with self._lock:
+            key = (data_store, operation, scale)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.record(value_ns, start_ns, num_records)
+
+    def drain(self) -> Dict[HistogramKey, LatencyHistogram]:
+        """
+        Returns the histograms recorded so far and starts afresh, so that a
+        warm process reports every invocation separately.
+        """
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+        return histograms
+
+
+latency_histograms = HistogramRegistry()
@@ -0,0 +1,466 @@
+import concurrent.futures
+import math
+import os
+import random
+import threading
+import time
+from logging import Logger
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src import cloudwatch as cw
+from src import es
+from src import postgres as rds
+from src import timestream as ts
+from src.helpers import new_record_id, timed_operation
+from src.histograms import LatencyHistogram
+from src.query_helpers import QueryType, es_max_buckets
+from src.results import get_result_sink
+
+log = Logger(name="load_helpers")
+# Stores to put under load, and the loads to step through: worker counts for
+# the closed loop, arrival rates (queries per second) for the open loop
+load_stores = os.getenv("LOAD_STORES", "elasticsearch,rds,timestream").split(",")
+load_closed_loop_workers = [
+    int(n) for n in os.getenv("LOAD_CLOSED_LOOP_WORKERS", "1,2,4,8,16").split(",")
+]
+load_open_loop_rates = [
+    float(r) for r in os.getenv("LOAD_OPEN_LOOP_RATES", "1,2,5,10,20").split(",")
+]
+# Seconds each load level runs for
+load_step_duration = float(os.getenv("LOAD_STEP_SECONDS", "20"))
+# Open loop: queries still queued or running this many seconds after the
+# last arrival are given up on (and counted as incomplete)
+load_drain_timeout = float(os.getenv("LOAD_DRAIN_TIMEOUT_SECONDS", "30"))
+load_open_loop_max_workers = int(os.getenv("LOAD_OPEN_LOOP_MAX_WORKERS", "64"))
+# Closed loop: a worker whose query failed waits before its next one, backing
+# off exponentially while the store keeps failing
+load_error_backoff_initial = 0.1
+load_error_backoff_max = 2
+# Relative weights of the query types, e.g. "1:4,2:1,3:1,4:2,5:2"
+load_query_mix = os.getenv("LOAD_QUERY_MIX", "1:1,2:1,3:1,4:1,5:1")
+# Read-while-write mode: closed-loop readers per store kept busy while the
+# writer's stage waves land
+mixed_read_workers = int(os.getenv("MIXED_READ_WORKERS", "2"))
+
+
+def parse_query_mix(mix: str) -> Dict[QueryType, float]:
+    weights = {}
+    for entry in mix.split(","):
+        query_type, weight = entry.split(":")
+        weights[QueryType(int(query_type))] = float(weight)
+    return weights
+
+
+def _query_chooser(mix: Dict[QueryType, float]) -> Callable[[], QueryType]:
+    query_types = list(mix)
+    weights = [mix[query_type] for query_type in query_types]
+    return lambda: random.choices(query_types, weights)[0]
+
+
+_thread_state = threading.local()
+_rds_clients: List[rds.PSQLClient] = []
+_rds_clients_lock = threading.Lock()
+
+
+def _rds_client() -> rds.PSQLClient:
+    # One connection per worker thread for the whole run: the pool only keeps
+    # a few idle connections, so acquiring per query would time connection
+    # setup whenever there are more workers than that
+    client = getattr(_thread_state, "rds_client", None)
+    if client is None:
+        client = _thread_state.rds_client = rds.PSQLClient(rds.pool.acquire())
+        with _rds_clients_lock:
+            _rds_clients.append(client)
+    return client
+
+
+def _release_rds_clients():
+    with _rds_clients_lock:
+        clients = list(_rds_clients)
+        _rds_clients.clear()
+    for client in clients:
+        client.cleanup()
+
+
+def _query_cw(query_type: QueryType, write_range: Tuple[int, int] = None):
+    start_time, end_time = write_range or (None, None)
+    cw.query(query_type.get_query("cw"), start_time, end_time)
+
+
+def _query_es(query_type: QueryType, _write_range=None):
+    for _ in es.aggregate_all(
+        es.read_target("monitoring_events"),
+        query_type.get_query("es"),
+        max_buckets=es_max_buckets.get(query_type)
+    ):
+        pass
+
+
+def _query_rds(query_type: QueryType, _write_range=None):
+    for _ in _rds_client().exec_prepared(str(query_type), query_type.get_query("rds")):
+        pass
+
+
+def _query_ts(query_type: QueryType, _write_range=None):
+    ts.get_client().query(query_type.get_query("ts"), columnar=True)
+
+
+query_runners = {
+    "cloudwatch": _query_cw,
+    "elasticsearch": _query_es,
+    "rds": _query_rds,
+    "timestream": _query_ts,
+}
+# Names the stores' reads are recorded under elsewhere, so that load results
+# line up with the other rows of the same store
+store_data_stores = {
+    "cloudwatch": "cloudwatch_logs",
+    "elasticsearch": es.data_store,
+    "rds": rds.data_store,
+    "timestream": "ts",
+}
+
+
+class LoadLevelResult:
+    def __init__(self):
+        self.histogram = LatencyHistogram()
+        # Open loop only: latency from the actual (not intended) start
+        self.service_histogram = LatencyHistogram()
+        self.errors = 0
+        self.incomplete = 0
+        self.elapsed_seconds = 0.0
+        # perf_counter_ns of the last recorded completion
+        self.last_end_ns: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def record(self, latency_ns: int, service_ns: int = None, end_ns: int = None):
+        with self._lock:
+            self.histogram.record(latency_ns)
+            if service_ns is not None:
+                self.service_histogram.record(service_ns)
+            if end_ns is not None and (self.last_end_ns is None or end_ns > self.last_end_ns):
+                self.last_end_ns = end_ns
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    @property
+    def throughput(self) -> float:
+        if self.elapsed_seconds <= 0:
+            return 0.0
+        return self.histogram.count / self.elapsed_seconds
+
+
+def run_closed_loop(
+    store: str,
+    num_workers: int,
+    duration: float,
+    mix: Dict[QueryType, float],
+    write_range: Tuple[int, int] = None
+) -> LoadLevelResult:
+    """
+    Runs `num_workers` clients that each issue their next query as soon as
+    the previous one returns, for `duration` seconds.
+    """
+    runner = query_runners[store]
+    choose = _query_chooser(mix)
+    result = LoadLevelResult()
+    deadline = time.perf_counter() + duration
+
+    def _worker():
+        backoff = load_error_backoff_initial
+        while time.perf_counter() < deadline:
+            start = time.perf_counter_ns()
+            try:
+                runner(choose(), write_range)
+            except Exception as e:
+                log.exception(e)
+                result.record_error()
+                time.sleep(max(0, min(backoff, deadline - time.perf_counter())))
+                backoff = min(backoff * 2, load_error_backoff_max)
+                continue
+            backoff = load_error_backoff_initial
+            result.record(time.perf_counter_ns() - start)
+
+    started_at = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for future in [executor.submit(_worker) for _ in range(num_workers)]:
+                future.result()
+    finally:
+        _release_rds_clients()
+    result.elapsed_seconds = time.perf_counter() - started_at
+    return result
+
+
+def run_open_loop(
+    store: str,
+    rate: float,
+    duration: float,
+    mix: Dict[QueryType, float],
+    write_range: Tuple[int, int] = None,
+    max_workers: int = load_open_loop_max_workers
+) -> LoadLevelResult:
+    """
+    Issues queries at a fixed arrival rate for `duration` seconds, whether or
+    not earlier ones have returned.
+
+    Latencies are measured from each query's intended start on the arrival
+    schedule, not from when a worker got to it, so that time spent queued
+    behind a saturated store is counted (coordinated-omission correction).
+    Latencies from the actual start are kept in `service_histogram`.
+
+    Queries that have not returned `load_drain_timeout` seconds after the last
+    arrival are only counted as incomplete, even if they return later.
+    """
+    runner = query_runners[store]
+    choose = _query_chooser(mix)
+    result = LoadLevelResult()
+    past_deadline = threading.Event()
+
+    def _issue(query_type: QueryType, intended_start: int):
+        if past_deadline.is_set():
+            return
+        start = time.perf_counter_ns()
+        try:
+            runner(query_type, write_range)
+        except Exception as e:
+            if not past_deadline.is_set():
+                log.exception(e)
+                result.record_error()
+            return
+        end = time.perf_counter_ns()
+        if not past_deadline.is_set():
+            result.record(end - intended_start, end - start, end)
+
+    interval_ns = int(1e9 / rate)
+    num_arrivals = int(duration * rate)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    schedule_start = time.perf_counter_ns()
+    try:
+        for i in range(num_arrivals):
+            intended_start = schedule_start + i * interval_ns
+            delay = (intended_start - time.perf_counter_ns()) / 1e9
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(_issue, choose(), intended_start))
+        _, not_done = concurrent.futures.wait(futures, timeout=load_drain_timeout)
+        past_deadline.set()
+        for future in not_done:
+            future.cancel()
+    finally:
+        past_deadline.set()
+        executor.shutdown(wait=True)
+        _release_rds_clients()
+    # Whatever was not recorded by the deadline, including queries that
+    # returned while it was being set
+    result.incomplete = num_arrivals - result.histogram.count - result.errors
+    # The level lasts for its arrival schedule, or until the last query
+    # that made the deadline returned, not until stragglers were waited out
+    schedule_end = schedule_start + num_arrivals * interval_ns
+    result.elapsed_seconds = (max(schedule_end, result.last_end_ns or 0) - schedule_start) / 1e9
+    return result
+
+
+def _record_load_level(
+    store: str,
+    mode: str,
+    scale: str,
+    level: float,
+    result: LoadLevelResult
+):
+    summary = result.histogram.summary()
+    print(
+        f"{store} {mode} {level}: {result.throughput:.2f} queries/s, "
+        f"p50 {summary['p50']} ms, p99 {summary['p99']} ms, {result.errors} errors"
+    )
+    item = {
+        "record_id": new_record_id(),
+        "data_store": store_data_stores[store],
+        "operation": f"load_{mode}__{scale}",
+        "load_level": level,
+        "throughput": round(result.throughput, 3),
+        "errors": result.errors,
+        "incomplete": result.incomplete,
+        "elapsed_seconds": round(result.elapsed_seconds, 3),
+        "histogram": result.histogram.to_dict(),
+        **summary,
+    }
+    if result.service_histogram.count:
+        service_summary = result.service_histogram.summary()
+        item["service_p50"] = service_summary["p50"]
+        item["service_p99"] = service_summary["p99"]
+    get_result_sink().record(
+        {name: value for name, value in item.items() if value is not None}
+    )
+
+
+def perform_load_test(
+    scale: str,
+    mode: str = "closed",
+    stores: List[str] = None,
+    levels: List[float] = None,
+    duration: float = load_step_duration,
+    mix: Dict[QueryType, float] = None,
+    write_range: Tuple[int, int] = None
+) -> Dict[str, List[dict]]:
+    """
+    Steps every store through increasing load and records one
+    throughput-vs-latency point per level, so that the level at which a store
+    saturates (throughput flattens while latency climbs) can be read off.
+
+    Args:
+        mode: "closed" (levels are worker counts) or "open" (levels are
+            arrival rates in queries per second)
+
+    Returns:
+        The curve of every store, as a list of points per store
+    """
+    if mode not in ("closed", "open"):
+        raise ValueError(f"Unknown load mode: {mode}")
+    stores = stores or load_stores
+    mix = mix or parse_query_mix(load_query_mix)
+    if levels is None:
+        levels = load_closed_loop_workers if mode == "closed" else load_open_loop_rates
+    print(f"Load testing data stores for scale {scale} ({mode} loop)...")
+
+    curves = {}
+    for store in stores:
+        curves[store] = []
+        for level in levels:
+            if mode == "closed":
+                result = run_closed_loop(store, int(level), duration, mix, write_range)
+            else:
+                result = run_open_loop(store, level, duration, mix, write_range)
+            _record_load_level(store, mode, scale, level, result)
+            curves[store].append(
+                {
+                    "load_level": level,
+                    "throughput": result.throughput,
+                    **result.histogram.summary(),
+                }
+            )
+    return curves
+
+
+class IngestRateTracker:
+    """
+    Follows the writer's stage waves, so that reads running alongside can be
+    tagged with the ingest going on at the time. A wave's rate is only known
+    once it has landed, so reads during a wave are tagged with the rate of
+    the previous one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wave_events = 0
+        self._wave_started_at = None
+        self._last_rate: Optional[float] = None
+
+    def start_wave(self, num_events: int):
+        with self._lock:
+            self._wave_events = num_events
+            self._wave_started_at = time.perf_counter()
+
+    def end_wave(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self._wave_started_at
+            if elapsed > 0:
+                self._last_rate = self._wave_events / elapsed
+            self._wave_events = 0
+            self._wave_started_at = None
+
+    def snapshot(self) -> Tuple[int, Optional[float]]:
+        """
+        Returns the events of the wave being written (0 between waves) and
+        the ingest rate in events per second (0 between waves, None during
+        the first wave).
+        """
+        with self._lock:
+            if self._wave_started_at is None:
+                return 0, 0.0
+            return self._wave_events, self._last_rate
+
+
+def ingest_rate_label(rate: Optional[float]) -> str:
+    # Coarse, order-of-magnitude bins, so that latency histograms of reads
+    # under similar ingest merge
+    if rate is None:
+        return "ingest_unknown"
+    if rate < 1:
+        return "ingest_idle"
+    return f"ingest_{10 ** int(math.log10(rate))}+"
+
+
+class BackgroundQueryLoad:
+    """
+    Closed-loop readers that run the query mix against every store until
+    stopped. Each read is recorded (as `<query type>__mixed`) with the
+    concurrent ingest rate taken from `ingest`, and failed reads are counted
+    per store and recorded on `stop`.
+    """
+
+    def __init__(
+        self,
+        ingest: IngestRateTracker,
+        stores: List[str] = None,
+        num_workers: int = mixed_read_workers,
+        mix: Dict[QueryType, float] = None
+    ):
+        self.ingest = ingest
+        self.stores = stores or load_stores
+        self.num_workers = num_workers
+        self.mix = mix or parse_query_mix(load_query_mix)
+        self.errors: Dict[str, int] = {store: 0 for store in self.stores}
+        self._errors_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _reader(self, store: str):
+        runner = query_runners[store]
+        choose = _query_chooser(self.mix)
+        while not self._stopped.is_set():
+            query_type = choose()
+            wave_events, ingest_rate = self.ingest.snapshot()
+            try:
+                with timed_operation(
+                    store_data_stores[store],
+                    f"{query_type}__mixed",
+                    scale=ingest_rate_label(ingest_rate),
+                    ingest_rate=int(ingest_rate) if ingest_rate is not None else None,
+                    concurrent_ingest_events=wave_events,
+                    read_workers=self.num_workers,
+                ):
+                    runner(query_type)
+            except Exception as e:
+                log.exception(e)
+                with self._errors_lock:
+                    self.errors[store] += 1
+                # Do not spin on a store that keeps failing
+                self._stopped.wait(1)
+
+    def start(self):
+        for store in self.stores:
+            for _ in range(self.num_workers):
+                thread = threading.Thread(target=self._reader, args=(store,), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        _release_rds_clients()
+        for store, errors in self.errors.items():
+            get_result_sink().record(
+                {
+                    "record_id": new_record_id(),
+                    "data_store": store_data_stores[store],
+                    "operation": "mixed_read_errors",
+                    "errors": errors,
+                    "read_workers": self.num_workers,
+                }
+            )
@@ -1,37 +1,69 @@
+import os
+
 from src.events import (
     IngestionJobStage,
-    generate_ingestion_job_events,
+    generate_event_batch,
     generate_ingestion_batch_pair
 )
-from src.write_helpers import write_events
+from src.write_helpers import write_events, write_session
 from src.query_helpers import perform_queries
+from src.helpers import record_latency_summaries
+from src.load_helpers import BackgroundQueryLoad, IngestRateTracker, perform_load_test
+from src.results import flush_results
+
+# Runs the reader's query mix continuously while the stage waves are written
+mixed_read_write = os.getenv("MIXED_READ_WRITE", "false") == "true"
 
 
-def writer_handler(_event, _context):
+def writer_handler(event, _context):
     batch_1, batch_2 = generate_ingestion_batch_pair(6000, 8000)
-    batch_1_job_events = generate_ingestion_job_events(batch_1)
-    batch_2_job_events = generate_ingestion_job_events(batch_2)
+    batch_1_events = generate_event_batch(batch_1)
+    batch_2_events = generate_event_batch(batch_2)
 
-    for job_events in [batch_1_job_events, batch_2_job_events]:
-        num_stages = IngestionJobStage.FINISHED + 1
-        errored_jobs = set()
-        for i in range(num_stages):
-            events = [
-                job.as_dict()
-                for job in job_events
-                if job.job_id not in errored_jobs
-            ]
-            write_events(events)
+    ingest = IngestRateTracker()
+    read_load = None
+    if (event or {}).get("mixed_read_write", mixed_read_write):
+        read_load = BackgroundQueryLoad(ingest)
+        read_load.start()
 
-            for job_event in job_events:
-                if job_event.errored:
-                    errored_jobs.add(job_event.job_id)
-                    continue
-                job_event.transition_to_next_stage()
+    try:
+        failed_writes = {}
+        with write_session():
+            for event_batch in [batch_1_events, batch_2_events]:
+                num_stages = IngestionJobStage.FINISHED + 1
+                for i in range(num_stages):
+                    ingest.start_wave(event_batch.num_active_jobs)
+                    errors = write_events(
+                        event_batch,
+                        read_workers=read_load.num_workers if read_load else 0
+                    )
+                    ingest.end_wave()
+                    for store in errors:
+                        failed_writes[store] = failed_writes.get(store, 0) + 1
+                    event_batch.transition_to_next_stage()
 
-    return {"num_jobs": batch_1.num_jobs + batch_2.num_jobs}
+        return {
+            "num_jobs": batch_1.num_jobs + batch_2.num_jobs,
+            "failed_writes": failed_writes,
+        }
+    finally:
+        if read_load is not None:
+            read_load.stop()
+        record_latency_summaries()
+        flush_results()
 
 
 def reader_handler(event, _context):
     scale = event.get("scale")
-    perform_queries(scale)
+    write_range = None
+    if event.get("write_start_time") is not None:
+        write_range = (event["write_start_time"], event.get("write_end_time"))
+    try:
+        load_mode = event.get("load_mode")
+        if load_mode:
+            perform_load_test(scale, load_mode, write_range=write_range)
+        else:
+            perform_queries(scale, write_range)
+    finally:
+        record_latency_summaries()
+        flush_results()
@@ -1,24 +1,407 @@
+import csv
+import io
 import os
-from typing import Any, Dict, List
+import re
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
 from uuid import uuid4
 
 import psycopg2
+from psycopg2.extensions import STATUS_READY
 from psycopg2.extras import execute_values
 
 from src.helpers import create_batches_from_list, timed_operation
 
 batch_size = 500
+copy_chunk_size = 1000
+copy_formats = ("csv", "binary")
+pool_size = int(os.getenv("RDS_POOL_SIZE", "4"))
+# Idle connections older than this (in seconds) are pinged before being reused
+health_check_interval = 30
 
+# "heap" keeps monitoring_events in a single table, "partitioned" range-partitions
+# it on `time`. Timings are recorded under a separate data store per layout so
+# that the scaling curves of both can be compared.
+table_layouts = ("heap", "partitioned")
+table_layout = os.getenv("RDS_TABLE_LAYOUT", "heap")
+data_store = "rds" if table_layout == "heap" else "rds_partitioned"
+partition_interval = timedelta(hours=int(os.getenv("RDS_PARTITION_INTERVAL_HOURS", "24")))
+partitions_ahead = int(os.getenv("RDS_PARTITIONS_AHEAD", "1"))
+# Partitions that end before now - retention are detached (or dropped)
+partition_retention_days = float(os.getenv("RDS_PARTITION_RETENTION_DAYS", "0"))
+drop_expired_partitions = os.getenv("RDS_DROP_EXPIRED_PARTITIONS", "false") == "true"
+# Keep the tables derived from monitoring_events up to date on every write.
+# Off by default, so that basic_write and copy_write__* time the plain load;
+# when on, the upserts are timed as the "derived_tables" phase of each write
+derived_tables_enabled = os.getenv("RDS_DERIVED_TABLES", "false") == "true"
+_partition_bound_pattern = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
 
-class PSQLClient:
+_PG_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_PG_COPY_TRAILER = struct.pack("!h", -1)
+_PG_EPOCH = datetime(2000, 1, 1)
+
+
+def _encode_binary_text(value: str) -> bytes:
+    return value.encode()
+
+
+def _encode_binary_integer(value: int) -> bytes:
+    return struct.pack("!i", value)
+
+
+def _encode_binary_boolean(value: bool) -> bytes:
+    return b"\x01" if value else b"\x00"
+
+
+def _encode_binary_timestamp(value: datetime) -> bytes:
+    delta = value - _PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return struct.pack("!q", micros)
+
+
+_binary_encoders = {
+    "text": _encode_binary_text,
+    "integer": _encode_binary_integer,
+    "boolean": _encode_binary_boolean,
+    "timestamp": _encode_binary_timestamp,
+}
+
+
+def _csv_chunks(rows: Iterable[tuple]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, copy_chunk_size))
+        if not chunk:
+            return
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _binary_chunks(
+    rows: Iterable[tuple],
+    encoders: List[Callable[[Any], bytes]]
+) -> Iterator[bytes]:
+    field_count = struct.pack("!h", len(encoders))
+    null_field = struct.pack("!i", -1)
+    buffer = bytearray(_PG_COPY_SIGNATURE)
+    for i, row in enumerate(rows):
+        buffer += field_count
+        for encode, value in zip(encoders, row):
+            if value is None:
+                buffer += null_field
+                continue
+            data = encode(value)
+            buffer += struct.pack("!i", len(data))
+            buffer += data
+        if (i + 1) % copy_chunk_size == 0:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += _PG_COPY_TRAILER
+    yield bytes(buffer)
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    File-like wrapper over a generator of byte chunks so that `copy_expert`
+    can stream a COPY payload without it ever being materialized in full.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._pending) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._pending += chunk
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+class DerivedTable(ABC):
+    """
+    A table kept up to date from the rows written to another table. Rows are
+    fed to `observe` as they are inserted or copied, and `flush` writes the
+    accumulated changes through the writer's cursor, in the same transaction
+    as the rows themselves.
+    """
+
+    table: str
+    # Table the derived rows are computed from
+    source_table = "monitoring_events"
+
+    def __init__(self, col_names: List[str]):
+        self._col_index = {col: i for i, col in enumerate(col_names)}
+
+    def create(self, client: "PSQLClient"):
+        """
+        Creates the table and, the first time it is created, fills it from the
+        rows already in `source_table`. An advisory lock keeps writers racing
+        to create it from backfilling twice.
+        """
+        with client.advisory_lock(f"create__{self.table}"):
+            existed = client.get_table_layout(self.table) is not None
+            self.create_schema(client)
+            if not existed and client.get_table_layout(self.source_table) is not None:
+                client.execute(self.backfill_query())
+
+    @abstractmethod
+    def create_schema(self, client: "PSQLClient"):
+        pass
+
+    @abstractmethod
+    def backfill_query(self) -> str:
+        pass
+
+    @abstractmethod
+    def observe(self, row: tuple):
+        pass
+
+    @abstractmethod
+    def flush(self, cursor):
+        pass
+
+
+class BatchSummaryTable(DerivedTable):
+    """
+    Per-batch aggregates of monitoring_events (what query types 2 and 3 work
+    out from the raw events), maintained incrementally with upserts.
+
+    Every job has exactly one IN_QUEUE event, so counting stage-0 events gives
+    the number of distinct jobs in a batch.
+    """
+
+    table = "ingestion_batch_summary"
+    col_name_and_types = {
+        "ingestion_batch_id": "text",
+        "user_id": "text",
+        "num_jobs": "integer",
+        "successful_jobs": "integer",
+        "errored_jobs": "integer",
+        "creation_time": "timestamp",
+        "last_updation_time": "timestamp",
+    }
+
+    def __init__(self, col_names: List[str]):
+        super().__init__(col_names)
+        self._summaries: Dict[str, list] = {}
+
+    def create_schema(self, client: "PSQLClient"):
+        client.create_table(self.table, "ingestion_batch_id", self.col_name_and_types)
+        client.create_index(self.table, "user_id")
+
+    def backfill_query(self) -> str:
+        return f"""
+        INSERT INTO {self.table} ({', '.join(self.col_name_and_types)})
+        SELECT ingestion_batch_id,
+               MIN(user_id),
+               COUNT(*) FILTER (WHERE stage_progress = 0),
+               COUNT(*) FILTER (WHERE finished),
+               COUNT(*) FILTER (WHERE errored),
+               MIN(created_at),
+               MAX(time)
+        FROM {self.source_table}
+        GROUP BY ingestion_batch_id
+        ON CONFLICT (ingestion_batch_id) DO NOTHING
+        """
+
+    def observe(self, row: tuple):
+        col = self._col_index
+        batch_id = row[col["ingestion_batch_id"]]
+        summary = self._summaries.get(batch_id)
+        if summary is None:
+            summary = [
+                batch_id,
+                row[col["user_id"]],
+                0,
+                0,
+                0,
+                row[col["created_at"]],
+                row[col["time"]],
+            ]
+            self._summaries[batch_id] = summary
+        summary[2] += row[col["stage_progress"]] == 0
+        summary[3] += bool(row[col["finished"]])
+        summary[4] += bool(row[col["errored"]])
+        summary[5] = min(summary[5], row[col["created_at"]])
+        summary[6] = max(summary[6], row[col["time"]])
+
+    def flush(self, cursor):
+        if not self._summaries:
+            return
+        query = f"""
+        INSERT INTO {self.table} AS summary ({', '.join(self.col_name_and_types)})
+        VALUES %s
+        ON CONFLICT (ingestion_batch_id) DO UPDATE SET
+            num_jobs = summary.num_jobs + excluded.num_jobs,
+            successful_jobs = summary.successful_jobs + excluded.successful_jobs,
+            errored_jobs = summary.errored_jobs + excluded.errored_jobs,
+            creation_time = LEAST(summary.creation_time, excluded.creation_time),
+            last_updation_time = GREATEST(
+                summary.last_updation_time,
+                excluded.last_updation_time
+            )
+        """
+        execute_values(cursor, query, [tuple(s) for s in self._summaries.values()])
+        self._summaries = {}
+
+
+class JobLatestStateTable(DerivedTable):
+    """
+    The newest event of every job, upserted so that it only ever moves
+    forward in time. Reading it costs O(jobs) however many stage transitions
+    have been logged.
+    """
+
+    table = "job_latest_state"
+    col_name_and_types = {
+        "job_id": "text",
+        "ingestion_batch_id": "text",
+        "stage": "text",
+        "stage_progress": "integer",
+        "errored": "boolean",
+        "time": "timestamp",
+    }
+
+    def __init__(self, col_names: List[str]):
+        super().__init__(col_names)
+        self._latest_states: Dict[str, tuple] = {}
+
+    def create_schema(self, client: "PSQLClient"):
+        client.create_table(self.table, "job_id", self.col_name_and_types)
+        client.create_index(self.table, "ingestion_batch_id")
+
+    def backfill_query(self) -> str:
+        return f"""
+        INSERT INTO {self.table} ({', '.join(self.col_name_and_types)})
+        SELECT DISTINCT ON (job_id) {', '.join(self.col_name_and_types)}
+        FROM {self.source_table}
+        ORDER BY job_id, time DESC
+        ON CONFLICT (job_id) DO NOTHING
+        """
+
+    def observe(self, row: tuple):
+        state = tuple(row[self._col_index[col]] for col in self.col_name_and_types)
+        current = self._latest_states.get(state[0])
+        # An upsert statement may touch every job only once, so keep the
+        # newest row per job
+        if current is None or state[-1] > current[-1]:
+            self._latest_states[state[0]] = state
+
+    def flush(self, cursor):
+        if not self._latest_states:
+            return
+        query = f"""
+        INSERT INTO {self.table} ({', '.join(self.col_name_and_types)})
+        VALUES %s
+        ON CONFLICT (job_id) DO UPDATE SET
+            ingestion_batch_id = excluded.ingestion_batch_id,
+            stage = excluded.stage,
+            stage_progress = excluded.stage_progress,
+            errored = excluded.errored,
+            time = excluded.time
+        WHERE excluded.time > {self.table}.time
+        """
+        execute_values(cursor, query, list(self._latest_states.values()))
+        self._latest_states = {}
+
+
+class PooledConnection:
     def __init__(self):
-        self._connection = psycopg2.connect(
-            host=os.getenv("RDS_DB_HOST"),
-            port=os.getenv("RDS_DB_PORT"),
-            dbname=os.getenv("RDS_DB_NAME"),
-            user=os.getenv("RDS_DB_USER"),
-            password=os.getenv("RDS_DB_PASSWORD"),
-        )
+        with timed_operation(data_store, "connection_setup"):
+            self.connection = psycopg2.connect(
+                host=os.getenv("RDS_DB_HOST"),
+                port=os.getenv("RDS_DB_PORT"),
+                dbname=os.getenv("RDS_DB_NAME"),
+                user=os.getenv("RDS_DB_USER"),
+                password=os.getenv("RDS_DB_PASSWORD"),
+            )
+        self.prepared_statements = set()
+        self.last_used_at = time.monotonic()
+
+    def is_healthy(self) -> bool:
+        if self.connection.closed:
+            return False
+        if time.monotonic() - self.last_used_at < health_check_interval:
+            return True
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            self.connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def close(self):
+        if not self.connection.closed:
+            self.connection.close()
+
+
+class PSQLPool:
+    """
+    Process-wide pool of Postgres connections. It lives at module level so
+    that warm Lambda invocations reuse connections (and the statements
+    prepared on them) instead of reconnecting.
+    """
+
+    def __init__(self, max_idle: int = pool_size):
+        self._max_idle = max_idle
+        self._idle: List[PooledConnection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> PooledConnection:
+        while True:
+            with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                return PooledConnection()
+            if pooled.is_healthy():
+                return pooled
+            pooled.close()
+
+    def release(self, pooled: PooledConnection):
+        if pooled.connection.closed:
+            return
+        if pooled.connection.status != STATUS_READY:
+            pooled.connection.rollback()
+        pooled.last_used_at = time.monotonic()
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(pooled)
+                return
+        pooled.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            pooled.close()
+
+
+pool = PSQLPool()
+
+
+class PSQLClient:
+    def __init__(self, pooled: PooledConnection = None):
+        self._pooled = pooled or PooledConnection()
+        self._connection = self._pooled.connection
 
     def create_table(
         self,
@@ -41,46 +424,319 @@ class PSQLClient:
         with self._connection.cursor() as cursor:
             cursor.execute(query)
 
+    def create_partitioned_table(
+        self,
+        table: str,
+        primary_key: str,
+        partition_key: str,
+        col_name_and_types: Dict[str, str]
+    ):
+        table_cols = [
+            f"{col_name} {col_type}"
+            for col_name, col_type in col_name_and_types.items()
+        ]
+        # The partition key has to be part of the primary key
+        table_cols.append(f"PRIMARY KEY ({primary_key}, {partition_key})")
+        query = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            {', '.join(table_cols)}
+        ) PARTITION BY RANGE ({partition_key})
+        """
+
+        with self._connection.cursor() as cursor:
+            cursor.execute(query)
+            self._connection.commit()
+
+    def get_table_layout(self, table: str) -> Optional[str]:
+        query = "SELECT relkind FROM pg_class WHERE relname = %s"
+        with self._connection.cursor() as cursor:
+            cursor.execute(query, (table,))
+            result = cursor.fetchone()
+        self._connection.commit()
+        if result is None:
+            return None
+        return "partitioned" if result[0] == "p" else "heap"
+
+    def _list_partitions(self, table: str) -> Dict[str, tuple]:
+        query = """
+        SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+        FROM pg_inherits
+        INNER JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        INNER JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = %s
+        """
+        partitions = {}
+        with self._connection.cursor() as cursor:
+            cursor.execute(query, (table,))
+            for name, bound in cursor.fetchall():
+                match = _partition_bound_pattern.search(bound or "")
+                if match:
+                    partitions[name] = (
+                        datetime.fromisoformat(match.group(1)),
+                        datetime.fromisoformat(match.group(2)),
+                    )
+        self._connection.commit()
+        return partitions
+
+    def ensure_partitions(self, table: str, start: datetime, end: datetime):
+        """
+        Creates the partitions of `table` covering [start, end], plus
+        `partitions_ahead` more after it so that upcoming writes never miss
+        a partition.
+        """
+        interval_seconds = int(partition_interval.total_seconds())
+        start_seconds = int(start.timestamp()) // interval_seconds * interval_seconds
+        partition_start = datetime.fromtimestamp(start_seconds)
+        last_start = end + partitions_ahead * partition_interval
+
+        existing = set(self._list_partitions(table))
+        with self._connection.cursor() as cursor:
+            while partition_start <= last_start:
+                partition_end = partition_start + partition_interval
+                partition = f"{table}__p{partition_start:%Y%m%d%H}"
+                if partition not in existing:
+                    cursor.execute(
+                        f"""
+                        CREATE TABLE IF NOT EXISTS {partition}
+                        PARTITION OF {table}
+                        FOR VALUES FROM (%s) TO (%s)
+                        """,
+                        (partition_start, partition_end)
+                    )
+                partition_start = partition_end
+        self._connection.commit()
+
+    def expire_partitions(self, table: str, retention: timedelta, drop: bool = False):
+        """
+        Detaches the partitions of `table` holding only data older than
+        `retention`, and drops them if `drop` is set.
+        """
+        cutoff = datetime.now() - retention
+        with self._connection.cursor() as cursor:
+            for partition, (_, partition_end) in self._list_partitions(table).items():
+                if partition_end > cutoff:
+                    continue
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {partition}")
+                if drop:
+                    cursor.execute(f"DROP TABLE {partition}")
+        self._connection.commit()
+
+    def execute(self, query: str, args: tuple = None):
+        with self._connection.cursor() as cursor:
+            cursor.execute(query, args)
+        self._connection.commit()
+
+    @contextmanager
+    def advisory_lock(self, name: str):
+        """
+        Holds a session-level advisory lock (keyed by `name`) across the
+        block, which may commit any number of times.
+        """
+        self.execute("SELECT pg_advisory_lock(hashtext(%s))", (name,))
+        try:
+            yield
+        finally:
+            # Session locks survive a rollback, which an error inside the
+            # block needs before anything else can run
+            self._connection.rollback()
+            self.execute("SELECT pg_advisory_unlock(hashtext(%s))", (name,))
+
     def create_index(self, table: str, column: str):
         query = f"CREATE INDEX IF NOT EXISTS {table}__{column} ON {table} ({column})"
         with self._connection.cursor() as cursor:
             cursor.execute(query)
             self._connection.commit()
 
-    def _insert_row_batch(self, table: str, rows: List[dict]):
-        col_names = ()
-        row_values_list = []
-        for row_data in rows:
-            col_names = list(row_data.keys())
-            row_values = tuple(row_data.values())
-            row_values_list.append(row_values)
+    def prepare(self, name: str, query: str):
+        """
+        Prepares `query` server-side as `name` on this connection, unless it
+        already has been. Prepared statements live as long as the connection,
+        so pooled connections keep them across invocations.
+        """
+        if name in self._pooled.prepared_statements:
+            return
+        with self._connection.cursor() as cursor:
+            cursor.execute(f"PREPARE {name} AS {query}")
+            self._connection.commit()
+        self._pooled.prepared_statements.add(name)
 
-        query = f"INSERT INTO {table} ({','.join(col_names)}) VALUES %s"
-        with timed_operation("rds", "basic_write", num_records=len(rows)):
+    def _insert_row_batch(
+        self,
+        table: str,
+        col_names: List[str],
+        rows: List[tuple],
+        derived_tables: List[DerivedTable] = (),
+    ):
+        # One multi-row INSERT per batch, as execute_values sends. Full
+        # batches go through a statement prepared for exactly batch_size
+        # rows; the last, shorter batch of a wave is sent with execute_values
+        # rather than preparing a statement for every remainder size.
+        num_cols = len(col_names)
+        use_prepared = len(rows) == batch_size
+        if use_prepared:
+            statement = f"insert__{table}__{batch_size}"
+            values = ", ".join(
+                "(" + ", ".join(f"${r * num_cols + c + 1}" for c in range(num_cols)) + ")"
+                for r in range(batch_size)
+            )
+            self.prepare(
+                statement,
+                f"INSERT INTO {table} ({','.join(col_names)}) VALUES {values}"
+            )
+            query = f"EXECUTE {statement} ({', '.join(['%s'] * (num_cols * batch_size))})"
+        else:
+            query = f"INSERT INTO {table} ({','.join(col_names)}) VALUES %s"
+        with timed_operation(data_store, "basic_write", num_records=len(rows)) as timer:
             with self._connection.cursor() as cursor:
-                execute_values(cursor, query, row_values_list)
+                if use_prepared:
+                    cursor.execute(query, [value for row in rows for value in row])
+                else:
+                    execute_values(cursor, query, rows, page_size=len(rows))
+                if derived_tables:
+                    with timer.phase("derived_tables"):
+                        for derived_table in derived_tables:
+                            for row in rows:
+                                derived_table.observe(row)
+                            derived_table.flush(cursor)
                 self._connection.commit()
 
-    def insert_rows(self, table: str, rows: List[dict]):
+    def insert_rows(
+        self,
+        table: str,
+        col_names: List[str],
+        rows: List[tuple],
+        derived_tables: List[DerivedTable] = (),
+    ):
         batches_of_rows = create_batches_from_list(rows, batch_size)
         for batch in batches_of_rows:
-            self._insert_row_batch(table, batch)
+            self._insert_row_batch(table, col_names, batch, derived_tables)
 
-    def exec_query(self, query: str, args: tuple = None):
-        with self._connection.cursor(name=f"rds_query_{uuid4()}") as cursor:
-            cursor.itersize = 10000
+    def _copy_row_chunk(
+        self,
+        table: str,
+        col_names: List[str],
+        rows: Iterable[tuple],
+        copy_format: str,
+        encoders: Optional[List[Callable[[Any], bytes]]],
+        derived_tables: List[DerivedTable] = (),
+    ) -> int:
+        num_rows = 0
 
-            cursor.execute(query, args)
-            for row in cursor:
+        def _counted(_rows):
+            nonlocal num_rows
+            for row in _rows:
+                num_rows += 1
+                for derived_table in derived_tables:
+                    derived_table.observe(row)
                 yield row
 
+        if copy_format == "binary":
+            chunks = _binary_chunks(_counted(rows), encoders)
+        else:
+            chunks = _csv_chunks(_counted(rows))
+        query = (
+            f"COPY {table} ({','.join(col_names)}) "
+            f"FROM STDIN WITH (FORMAT {copy_format})"
+        )
+        with self._connection.cursor() as cursor:
+            cursor.copy_expert(query, _ChunkReader(chunks))
+        return num_rows
+
+    def copy_rows(
+        self,
+        table: str,
+        col_names: List[str],
+        rows: Iterable[tuple],
+        col_types: Dict[str, str] = None,
+        copy_format: str = "csv",
+        commit_every: int = None,
+        derived_tables: List[DerivedTable] = (),
+    ):
+        """
+        Bulk-loads `rows` into `table` with `COPY ... FROM STDIN`, streaming
+        them from the iterable in chunks.
+
+        Args:
+            table (str): destination table
+            col_names (list): columns, in the order of the values in each row
+            rows (iterable): row tuples; may be a generator
+            col_types (dict, optional): Postgres type of every column in
+                `col_names`. Required for the binary format.
+            copy_format (str, optional): "csv" or "binary". Defaults to "csv".
+            commit_every (int, optional): number of rows loaded per COPY
+                statement and transaction. Defaults to a single transaction.
+            derived_tables (list, optional): tables to update from the
+                copied rows, in the same transaction as each COPY.
+        """
+        if copy_format not in copy_formats:
+            raise ValueError(f"Unsupported COPY format: {copy_format}")
+
+        encoders = None
+        if copy_format == "binary":
+            encoders = [_binary_encoders[col_types[col]] for col in col_names]
+
+        rows = iter(rows)
+        operation = f"copy_write__{copy_format}"
+        while True:
+            first_row = next(rows, None)
+            if first_row is None:
+                return
+            chunk = chain([first_row], rows)
+            if commit_every:
+                chunk = islice(chunk, commit_every)
+            with timed_operation(data_store, operation) as timer:
+                timer.num_records = self._copy_row_chunk(
+                    table, col_names, chunk, copy_format, encoders, derived_tables
+                )
+                if derived_tables:
+                    # Rows are observed while they stream into the COPY; the
+                    # phase covers the upserts
+                    with timer.phase("derived_tables"), self._connection.cursor() as cursor:
+                        for derived_table in derived_tables:
+                            derived_table.flush(cursor)
+                self._connection.commit()
+
+    def exec_query(self, query: str, args: tuple = None):
+        try:
+            with self._connection.cursor(name=f"rds_query_{uuid4()}") as cursor:
+                cursor.itersize = 10000
+
+                cursor.execute(query, args)
+                for row in cursor:
+                    yield row
+        finally:
+            # Long-lived reader connections must not sit idle in a
+            # transaction, holding locks that block partition DDL
+            self._connection.rollback()
+
+    def exec_prepared(self, name: str, query: str, args: tuple = None):
+        """
+        Runs the statement prepared as `name`. EXECUTE cannot back a
+        server-side cursor, so the result is fetched whole and the
+        transaction ended before any row is yielded.
+        """
+        self.prepare(name, query)
+        try:
+            with self._connection.cursor() as cursor:
+                if args:
+                    cursor.execute(
+                        f"EXECUTE {name} ({', '.join(['%s'] * len(args))})",
+                        args
+                    )
+                else:
+                    cursor.execute(f"EXECUTE {name}")
+                rows = cursor.fetchall()
+        finally:
+            self._connection.rollback()
+        yield from rows
+
     def cleanup(self):
-        self._connection.close()
+        pool.release(self._pooled)
 
 
 class PSQLConnection:
     def __enter__(self):
-        self.client = PSQLClient()
+        self.client = PSQLClient(pool.acquire())
         return self.client
 
     def __exit__(self, exc_type, exc_value, traceback):
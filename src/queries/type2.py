@@ -82,12 +82,25 @@ queries = {
         ) AS m2 ON true
     """,
 
+    # ================================ PostgresSQL ================================
+    # Reads the incrementally maintained per-batch summary instead of the events
+    "rds_summary": """
+        SELECT ingestion_batch_id,
+               num_jobs,
+               successful_jobs,
+               errored_jobs,
+               creation_time,
+               last_updation_time
+        FROM ingestion_batch_summary
+        LIMIT 100
+    """,
+
     # ================================ Timestream =================================
     "ts": """
         SELECT ingestion_batch_id,
                COUNT(DISTINCT(job_id)) AS num_jobs,
-               SUM(CAST(finished AS integer)) AS successful_jobs,
-               SUM(CAST(errored AS integer)) AS errored_jobs,
+               COUNT_IF(finished) AS successful_jobs,
+               COUNT_IF(errored) AS errored_jobs,
                MIN(created_at) AS creation_time,
                MAX(time) AS last_updation_time
         FROM "DataplatformPlayMonitoringV1"."MonitoringEvents"
@@ -79,6 +79,18 @@ queries = {
         ) AS j2 ON true
     """,
 
+    # ================================ PostgresSQL ================================
+    # Reads the upserted latest state of every job instead of the event history
+    "rds_latest_state": """
+        SELECT job_id,
+               stage,
+               stage_progress,
+               errored,
+               time AS last_updation_time
+        FROM job_latest_state
+        WHERE ingestion_batch_id = '16554252419__1661749456__1110'
+    """,
+
     # ================================ Timestream =================================
     "ts": """
         SELECT job_id,
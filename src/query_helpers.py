@@ -1,16 +1,23 @@
+import os
 from enum import Enum
+from typing import Tuple
 
 from src import cloudwatch as cw
 from src import es
 from src import postgres as rds
 from src import timestream as ts
-from src.helpers import timed_operation
+from src.helpers import record_latency_summaries, timed_operation
+from src.histograms import latency_histograms
 from src.queries.type1 import queries as type1_queries
 from src.queries.type2 import queries as type2_queries
 from src.queries.type3 import queries as type3_queries
 from src.queries.type4 import queries as type4_queries
 from src.queries.type5 import queries as type5_queries
 
+# "sequential" times one Insights query at a time, "concurrent" starts all
+# repetitions of a query type at once (within the concurrent-query limit)
+cw_query_mode = os.getenv("CW_QUERY_MODE", "sequential")
+
 
 class QueryType(Enum):
     TYPE_I = 1
@@ -35,12 +42,45 @@ class QueryType(Enum):
         return f"query_type_{self.value}"
 
 
-def _query_from_cw(query_type: QueryType, scale: str):
+# Composite aggregations are paged through fully, except for the query types
+# whose queries on the other stores stop at LIMIT 100
+es_max_buckets = {
+    QueryType.TYPE_I: 100,
+    QueryType.TYPE_II: 100,
+}
+
+
+def _query_from_cw(query_type: QueryType, scale: str, write_range: Tuple[int, int] = None):
     query = query_type.get_query("cw")
     operation = f"{query_type}__{scale}"
+    start_time, end_time = write_range or (None, None)
+    if cw_query_mode == "concurrent":
+        num_queries = 10
+        with timed_operation(
+            "cloudwatch_logs",
+            f"{query_type}__concurrent__{scale}",
+            num_queries=num_queries,
+            query_mode=cw_query_mode,
+            scale=scale,
+        ) as timer:
+            outcomes = cw.query_many([query] * num_queries, start_time, end_time)
+            timer.attributes["query_latencies"] = [
+                int(latency * 1000) for _, latency in outcomes
+            ]
+        for _, latency in outcomes:
+            latency_histograms.record(
+                "cloudwatch_logs", operation, int(latency * 1e9), scale=scale
+            )
+        return
+
     for i in range(10):
-        with timed_operation("cloudwatch_logs", operation, is_first_query=(i == 0)):
-            res = cw.query(query)
+        with timed_operation(
+            "cloudwatch_logs",
+            operation,
+            is_first_query=(i == 0),
+            scale=scale,
+        ):
+            res = cw.query(query, start_time, end_time)
         for _ in res:
             pass
 
@@ -49,31 +89,87 @@ def _query_from_es(query_type: QueryType, scale: str):
     query = query_type.get_query("es")
     operation = f"{query_type}__{scale}"
     for i in range(10):
-        with timed_operation("elasticsearch", operation, is_first_query=(i == 0)):
-            es.query("monitoring_events", query)
+        with timed_operation(
+            es.data_store,
+            operation,
+            is_first_query=(i == 0),
+            reuse_connections=es.reuse_connections,
+            scale=scale,
+        ) as timer:
+            # Page through as many buckets as the other stores return rows,
+            # so that ES does the same amount of work
+            stats = es.AggregationStats()
+            for _ in es.aggregate_all(
+                es.read_target("monitoring_events"),
+                query,
+                stats,
+                max_buckets=es_max_buckets.get(query_type)
+            ):
+                pass
+            timer.attributes["num_pages"] = stats.pages
+            timer.attributes["num_buckets"] = stats.buckets
+            timer.add_phase("send", stats.request_ns)
+            timer.add_phase("server", stats.server_took_ms * 1_000_000)
+
+
+# Query variants reading tables derived from monitoring_events, keyed by the
+# suffix they are recorded under (as part of the data store). They are only
+# queried when RDS_DERIVED_TABLES keeps the derived tables up to date
+rds_query_variants = {
+    "rds": "",
+    "rds_summary": "_summary",
+    "rds_latest_state": "_latest_state",
+}
 
 
 def _query_from_rds(query_type: QueryType, scale: str):
-    query = query_type.get_query("rds")
     operation = f"{query_type}__{scale}"
     with rds.PSQLConnection() as connection:
-        for i in range(10):
-            with timed_operation("rds", operation, is_first_query=(i == 0)):
-                res = connection.exec_query(query)
-                for _ in res:
-                    pass
+        for variant, suffix in rds_query_variants.items():
+            query = query_type.get_query(variant)
+            if query is None or (suffix and not rds.derived_tables_enabled):
+                continue
+            data_store = f"{rds.data_store}{suffix}"
+            for i in range(10):
+                with timed_operation(
+                    data_store,
+                    operation,
+                    is_first_query=(i == 0),
+                    scale=scale,
+                ):
+                    res = connection.exec_prepared(f"{query_type}{suffix}", query)
+                    for _ in res:
+                        pass
 
 
 def _query_from_ts(query_type: QueryType, scale: str):
     query = query_type.get_query("ts")
     operation = f"{query_type}__{scale}"
-    ts_client = ts.Timestream()
+    ts_client = ts.get_client()
     for i in range(10):
-        with timed_operation("ts", operation, is_first_query=(i == 0)):
-            ts_client.query(query)
-
-
-def perform_queries(scale):
+        with timed_operation(
+            "ts",
+            operation,
+            is_first_query=(i == 0),
+            scale=scale,
+        ) as timer:
+            stats = ts.QueryStats()
+            ts_client.query(query, columnar=True, stats=stats)
+            timer.attributes["num_rows"] = stats.num_rows
+            timer.add_phase("send", stats.request_seconds * 1e9)
+            timer.add_phase("decode", stats.decode_seconds * 1e9)
+            rows_per_second = stats.decoded_rows_per_second
+            if rows_per_second is not None:
+                timer.attributes["decoded_rows_per_sec"] = int(rows_per_second)
+
+
+def perform_queries(scale, write_range: Tuple[int, int] = None):
+    """
+    Args:
+        scale: Label of the cumulative scale being queried
+        write_range: (start, end) epoch ms of the events written so far, used
+            to bound the CloudWatch Insights query window
+    """
     print(f"Querying data stores for scale {scale}...")
 
     query_types = [
@@ -85,7 +181,7 @@ def perform_queries(scale):
     ]
     for query_type in query_types:
         print(f"-> cloudwatch, {query_type}")
-        _query_from_cw(query_type, scale)
+        _query_from_cw(query_type, scale, write_range)
 
         print(f"-> elasticsearch, {query_type}")
         _query_from_es(query_type, scale)
@@ -95,3 +191,5 @@ def perform_queries(scale):
 
         print(f"-> timestream, {query_type}")
         _query_from_ts(query_type, scale)
+
+    record_latency_summaries()
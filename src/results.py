@@ -0,0 +1,210 @@
+import atexit
+import json
+import os
+import threading
+from decimal import Decimal
+from logging import Logger
+from typing import List
+
+import boto3
+import numpy as np
+
+log = Logger(name="results")
+# One of "dynamodb", "jsonl" or "npz"
+result_sink_backend = os.getenv("RESULT_SINK", "dynamodb")
+# Directory the file backends write into
+result_sink_path = os.getenv("RESULT_SINK_PATH", "/tmp/benchmark_results")
+# Buffered records are flushed by a background thread every this many
+# seconds, or as soon as this many records are waiting
+result_sink_flush_interval = float(os.getenv("RESULT_SINK_FLUSH_INTERVAL", "5"))
+result_sink_max_buffer = int(os.getenv("RESULT_SINK_MAX_BUFFER", "500"))
+
+
+def _to_dynamodb(value):
+    # DynamoDB rejects floats, numbers have to be Decimals
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, list):
+        return [_to_dynamodb(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_dynamodb(v) for k, v in value.items()}
+    return value
+
+
+class DynamoDBBackend:
+    def __init__(self, table_name: str = None):
+        # boto3's default session is not thread-safe, and records are flushed
+        # from a background thread
+        self._table = boto3.session.Session().resource("dynamodb").Table(
+            table_name or os.getenv("BENCHMARK_DATA_TABLE_NAME")
+        )
+
+    def write(self, records: List[dict]):
+        with self._table.batch_writer(
+            overwrite_by_pkeys=["operation", "record_id"]
+        ) as batch:
+            for record in records:
+                batch.put_item(Item=_to_dynamodb(record))
+
+
+class JSONLBackend:
+    def __init__(self, directory: str = None):
+        directory = directory or result_sink_path
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"results-{os.getpid()}.jsonl")
+
+    def write(self, records: List[dict]):
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+
+def _to_column(values: list) -> np.ndarray:
+    # Columns are kept to dtypes that load without pickle: numbers (floats
+    # with NaN where a record lacks the field) and fixed-width text (empty
+    # where missing, nested values such as phase times as JSON)
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, (bool, int, float)) for value in present):
+        if len(present) == len(values):
+            if all(isinstance(value, bool) for value in values):
+                return np.array(values, dtype=bool)
+            if not any(isinstance(value, float) for value in values):
+                return np.array(values, dtype=np.int64)
+        return np.array(
+            [np.nan if value is None else float(value) for value in values],
+            dtype=np.float64
+        )
+    return np.array(
+        [
+            "" if value is None
+            else json.dumps(value) if isinstance(value, (dict, list))
+            else str(value)
+            for value in values
+        ],
+        dtype=str
+    )
+
+
+class NpzBackend:
+    """
+    Writes every flush as a columnar NumPy `.npz` part file, one array per
+    field, since records of different operations carry different attributes.
+    Parts load with a plain `np.load(path)`.
+    """
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or result_sink_path
+        os.makedirs(self.directory, exist_ok=True)
+        self._num_parts = 0
+
+    def write(self, records: List[dict]):
+        # Column-wise over the union of fields, as records of different
+        # operations do not share a schema
+        names = list(dict.fromkeys(name for record in records for name in record))
+        path = os.path.join(
+            self.directory,
+            f"results-{os.getpid()}-{self._num_parts:05d}.npz"
+        )
+        np.savez_compressed(
+            path,
+            **{name: _to_column([record.get(name) for record in records]) for name in names}
+        )
+        self._num_parts += 1
+
+
+result_sink_backends = {
+    "dynamodb": DynamoDBBackend,
+    "jsonl": JSONLBackend,
+    "npz": NpzBackend,
+}
+
+
+class ResultSink:
+    """
+    Buffers benchmark records and hands them to a backend in batches, on a
+    background thread or on an explicit `flush`, so that recording results
+    stays out of the timed code.
+    """
+
+    def __init__(
+        self,
+        backend,
+        flush_interval: float = result_sink_flush_interval,
+        max_buffer: int = result_sink_max_buffer
+    ):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        # Serializes backend writes between the background thread and flush()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def record(self, item: dict):
+        with self._buffer_lock:
+            self._buffer.append(item)
+            is_full = len(self._buffer) >= self.max_buffer
+        if is_full:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes all buffered records. Records that fail to be written are put
+        back in the buffer before the error is raised.
+        """
+        with self._flush_lock:
+            with self._buffer_lock:
+                records, self._buffer = self._buffer, []
+            if not records:
+                return
+            try:
+                self.backend.write(records)
+            except Exception:
+                with self._buffer_lock:
+                    self._buffer = records + self._buffer
+                raise
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception(e)
+
+
+_result_sink = None
+_result_sink_lock = threading.Lock()
+
+
+def get_result_sink() -> ResultSink:
+    """
+    Returns the process-wide result sink, created on first use with the
+    backend selected by RESULT_SINK.
+    """
+    global _result_sink
+    with _result_sink_lock:
+        if _result_sink is None:
+            _result_sink = ResultSink(result_sink_backends[result_sink_backend]())
+            atexit.register(_result_sink.close)
+        return _result_sink
+
+
+def flush_results():
+    """
+    Writes out all buffered records; handlers call this before returning, as
+    a frozen Lambda process may never run the background flush.
+    """
+    if _result_sink is not None:
+        _result_sink.flush()
@@ -1,15 +1,70 @@
+import collections
 import concurrent.futures
+import functools
 import os
+import random
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime
 from logging import Logger
-from typing import Any, Dict, Iterator, List, Optional, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import boto3
+import numpy as np
 from botocore.config import Config
+from botocore.exceptions import (
+    ConnectionClosedError,
+    EndpointConnectionError,
+    ReadTimeoutError
+)
 
 from src.helpers import create_batches_from_list, timed_operation
 
 batch_size = 100
+write_max_in_flight = int(os.getenv("TS_WRITE_MAX_IN_FLIGHT", "64"))
+write_max_retries = 8
+# Connection-level failures; botocore does not retry writes, so batches that
+# hit them are requeued
+_retryable_connection_errors = (
+    EndpointConnectionError,
+    ReadTimeoutError,
+    ConnectionClosedError,
+)
+# Rejected records whose reason mentions one of these are requeued
+_retryable_reasons = ("throttl", "internal", "try again")
+
+
+def _encode_boolean(value: Any) -> str:
+    return "true" if value else "false"
+
+
+def _encode_integer(value: Any) -> str:
+    return str(int(value))
+
+
+# Writes carry every value as a string in the type's canonical form;
+# TIMESTAMP measures are epoch milliseconds
+_value_encoders: Dict[str, Callable[[Any], str]] = {
+    "VARCHAR": str,
+    "BIGINT": _encode_integer,
+    "DOUBLE": repr,
+    "BOOLEAN": _encode_boolean,
+    "TIMESTAMP": _encode_integer,
+}
+
+
+@dataclass
+class RecordTemplate:
+    time_col: str
+    # (column, Timestream type, value encoder) per dimension/measure
+    dimensions: List[Tuple[str, str, Callable[[Any], str]]]
+    common_dimensions: List[Tuple[str, str, Callable[[Any], str]]]
+    measures: List[Tuple[str, str, Callable[[Any], str]]]
+
+
+# Record templates, built once per write schema
+_record_templates: Dict[tuple, RecordTemplate] = {}
 
 
 def _cast_value(value: str, data_type: str) -> Any:
@@ -32,31 +87,6 @@ def _cast_value(value: str, data_type: str) -> Any:
     raise ValueError(f"Unsupported Amazon Timestream type: {data_type}")
 
 
-def _process_row_data(schema: List[Dict[str, str]], row_data: Dict[str, Any]):
-    row_processed = []
-    for col_schema, col in zip(schema, row_data["Data"]):
-        if col.get("NullValue", False):
-            row_processed.append(None)
-        elif "ScalarValue" in col:
-            row_processed.append(
-                _cast_value(
-                    value=col["ScalarValue"],
-                    data_type=col_schema["type"]
-                )
-            )
-        elif "ArrayValue" in col:
-            row_processed.append(
-                _cast_value(value=col["ArrayValue"], data_type="ARRAY")
-            )
-        else:
-            raise ValueError(
-                f"Query with non ScalarType/ArrayColumnInfo/NullValue for "
-                f"column {col_schema['name']}. "
-                f"Expected {col_schema['type']} instead of {col}"
-            )
-    return row_processed
-
-
 def _process_schema(page: Dict[str, Any]) -> List[Dict[str, str]]:
     schema: List[Dict[str, str]] = []
     for col in page["ColumnInfo"]:
@@ -79,18 +109,131 @@ def _process_schema(page: Dict[str, Any]) -> List[Dict[str, str]]:
     return schema
 
 
-def _serialize_rows(
-    row_list: List[List[Any]],
-    schema: List[Dict[str, str]]
-) -> List[Dict[str, Any]]:
-    rows = []
-    column_names = [c["name"] for c in schema]
-    for row_data in row_list:
-        row = {}
-        for k, v in zip(column_names, row_data):
-            row[k] = v
-        rows.append(row)
-    return rows
+def _parse_boolean(value: str) -> bool:
+    return value == "true"
+
+
+def _parse_timestamp(value: str) -> datetime:
+    # Timestamps come with nanoseconds (2022-08-29 05:04:16.123456789);
+    # fromisoformat takes the first 26 characters (down to microseconds)
+    try:
+        return datetime.fromisoformat(value[:26])
+    except ValueError:
+        return _cast_value(value, "TIMESTAMP")
+
+
+_fast_converters: Dict[str, Callable[[str], Any]] = {
+    "BIGINT": int,
+    "INTEGER": int,
+    "DOUBLE": float,
+    "BOOLEAN": _parse_boolean,
+    "TIMESTAMP": _parse_timestamp,
+}
+
+# Column types that can be turned into NumPy arrays when they have no NULLs
+_numpy_dtypes = {
+    "BIGINT": np.int64,
+    "INTEGER": np.int64,
+    "DOUBLE": np.float64,
+    "BOOLEAN": np.bool_,
+    "TIMESTAMP": "datetime64[us]",
+}
+
+
+def _cell_converter(col_schema: Dict[str, Any]) -> Callable[[Dict[str, Any]], Any]:
+    col_type = col_schema["type"]
+    if not isinstance(col_type, str):
+        def _convert_array(cell):
+            if "ArrayValue" in cell:
+                return _cast_value(value=cell["ArrayValue"], data_type="ARRAY")
+            if cell.get("NullValue", False):
+                return None
+            raise ValueError(
+                f"Expected an array for column {col_schema['name']} instead of {cell}"
+            )
+        return _convert_array
+
+    if col_type == "VARCHAR":
+        convert = None
+    else:
+        convert = _fast_converters.get(col_type) or functools.partial(
+            _cast_value, data_type=col_type
+        )
+
+    def _convert_scalar(cell):
+        value = cell.get("ScalarValue")
+        if value is None:
+            if cell.get("NullValue", False):
+                return None
+            raise ValueError(
+                f"Query with non ScalarType/ArrayColumnInfo/NullValue for "
+                f"column {col_schema['name']}. "
+                f"Expected {col_type} instead of {cell}"
+            )
+        return value if convert is None else convert(value)
+
+    return _convert_scalar
+
+
+class ResultDecoder:
+    """
+    Decodes query result rows with one converter per column, compiled once
+    from the result's ColumnInfo.
+    """
+
+    def __init__(self, schema: List[Dict[str, Any]]):
+        self.schema = schema
+        self.column_names = [col["name"] for col in schema]
+        self._converters = [_cell_converter(col) for col in schema]
+
+    def decode_rows(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        converters = list(zip(self.column_names, self._converters))
+        return [
+            {
+                name: convert(cell)
+                for (name, convert), cell in zip(converters, row["Data"])
+            }
+            for row in rows
+        ]
+
+    def decode_columns(self, rows: List[Dict[str, Any]]) -> Dict[str, list]:
+        cells_per_column = zip(*(row["Data"] for row in rows))
+        return {
+            name: [convert(cell) for cell in cells]
+            for name, convert, cells in zip(
+                self.column_names,
+                self._converters,
+                cells_per_column
+            )
+        }
+
+    def to_arrays(self, columns: Dict[str, list]) -> Dict[str, Any]:
+        """
+        Turns numeric, boolean and timestamp columns without NULLs into
+        NumPy arrays; other columns are left as lists.
+        """
+        arrays = {}
+        for col in self.schema:
+            values = columns.get(col["name"], [])
+            dtype = _numpy_dtypes.get(col["type"]) if isinstance(col["type"], str) else None
+            if dtype is not None and None not in values:
+                arrays[col["name"]] = np.array(values, dtype=dtype)
+            else:
+                arrays[col["name"]] = values
+        return arrays
+
+
+@dataclass
+class QueryStats:
+    num_rows: int = 0
+    request_seconds: float = 0
+    decode_seconds: float = 0
+
+    @property
+    def decoded_rows_per_second(self) -> Optional[float]:
+        if self.decode_seconds <= 0:
+            return None
+        return self.num_rows / self.decode_seconds
 
 
 def wrap_in_pagination_query(
@@ -118,22 +261,108 @@ def wrap_in_pagination_query(
     '''
 
 
+class WriteConcurrencyController:
+    """
+    AIMD (additive-increase, multiplicative-decrease) limit on in-flight
+    WriteRecords requests. Each request that comes back without throttling
+    and within `target_latency` seconds grows the limit by 1/limit (about one
+    slot per round of requests). A throttled request halves it.
+
+    It also keeps running counters, so that a table's real ingest ceiling
+    can be read off `snapshot()` while writes are going on.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        target_latency: float = 1.0
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.records_written = 0
+        self.throttles = 0
+        self.requeued_records = 0
+        self.dropped_records = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._in_flight >= int(self._limit):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self, latency: float, throttled: bool, records_written: int):
+        with self._lock:
+            self._in_flight -= 1
+            self.requests += 1
+            self.request_seconds += latency
+            self.records_written += records_written
+            if throttled:
+                self.throttles += 1
+                self._limit = max(self.min_limit, self._limit / 2)
+            elif latency <= self.target_latency:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    def record_requeued(self, num_records: int):
+        with self._lock:
+            self.requeued_records += num_records
+
+    def record_dropped(self, num_records: int):
+        with self._lock:
+            self.dropped_records += num_records
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = time.monotonic() - self._started_at
+            return {
+                "in_flight_limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "requests": self.requests,
+                "request_seconds": self.request_seconds,
+                "records_written": self.records_written,
+                "records_per_sec": int(self.records_written / elapsed) if elapsed else 0,
+                "throttles": self.throttles,
+                "requeued_records": self.requeued_records,
+                "dropped_records": self.dropped_records,
+            }
+
+
 class Timestream:
 
     def __init__(self):
+        # A session of its own, since boto3's default session is not
+        # thread-safe and writes are fanned out over threads
+        session = boto3.session.Session()
         ts_read_config = Config(read_timeout=60, retries={"max_attempts": 10})
-        self._read_client = boto3.client(
+        self._read_client = session.client(
             'timestream-query',
             config=ts_read_config,
             region_name="us-west-2"
         )
+        self.write_controller = WriteConcurrencyController(max_limit=write_max_in_flight)
+        # Throttling is left to the write controller rather than botocore, so
+        # that it can see it and back off. The legacy `max_attempts` counts
+        # retries, so a single attempt is `total_max_attempts`.
         ts_write_config = Config(
             read_timeout=20,
-            max_pool_connections=5000,
-            retries={"max_attempts": 10},
+            max_pool_connections=write_max_in_flight,
+            retries={"total_max_attempts": 1},
             region_name="us-west-2"
         )
-        self._write_client = boto3.client('timestream-write', config=ts_write_config)
+        self._write_client = session.client('timestream-write', config=ts_write_config)
 
         table_id = os.getenv("TS_TABLE_ID")
         self._table, self._db = table_id.split(":")
@@ -144,29 +373,65 @@ class Timestream:
         self,
         sql: str,
         pagination_config: Optional[Dict[str, Any]],
-        transform=False
-    ) -> Iterator[List[Dict[str, Any]]]:
+        transform=False,
+        columnar=False,
+        stats: QueryStats = None
+    ) -> Iterator[Tuple[Optional[ResultDecoder], Any]]:
+        """
+        Yields every page of the result as a (decoder, page) pair. The page
+        holds raw rows, decoded rows (`transform`) or decoded columns
+        (`columnar`); the decoder is None for raw rows.
+        """
         paginator = self._read_client.get_paginator("query")
-        row_list: List[List[Any]] = []
-        schema: List[Dict[str, str]] = []
+        decoder: Optional[ResultDecoder] = None
         page_iterator = paginator.paginate(
             QueryString=sql,
             PaginationConfig=pagination_config or {}
         )
-        for page in page_iterator:
-            if transform:
-                if not schema:
-                    schema = _process_schema(page=page)
-                    self._logger.info("schema: %s", schema)
-                for row_data in page["Rows"]:
-                    row_list.append(_process_row_data(schema, row_data))
-                if len(row_list) > 0:
-                    yield _serialize_rows(row_list, schema)
-                row_list = []
+        pages = iter(page_iterator)
+        while True:
+            request_start = time.perf_counter()
+            page = next(pages, None)
+            if stats is not None:
+                stats.request_seconds += time.perf_counter() - request_start
+            if page is None:
+                return
+            if not (transform or columnar):
+                yield None, page["Rows"]
+                continue
+
+            if decoder is None:
+                decoder = ResultDecoder(_process_schema(page=page))
+                self._logger.info("schema: %s", decoder.schema)
+            rows = page["Rows"]
+            if len(rows) == 0:
+                continue
+            decode_start = time.perf_counter()
+            if columnar:
+                decoded = decoder.decode_columns(rows)
             else:
-                yield page["Rows"]
+                decoded = decoder.decode_rows(rows)
+            if stats is not None:
+                stats.decode_seconds += time.perf_counter() - decode_start
+                stats.num_rows += len(rows)
+            yield decoder, decoded
 
-    def query(self, sql: str, page_size: int = 100, chunked=False, transform=False):
+    def query(
+        self,
+        sql: str,
+        page_size: int = 100,
+        chunked=False,
+        transform=False,
+        columnar=False,
+        stats: QueryStats = None
+    ):
+        """
+        Runs `sql` and returns its rows: raw Timestream rows by default,
+        dicts with `transform`, or (with `columnar`) a dict of column name to
+        NumPy array, or list for columns that cannot be one. With `chunked`,
+        pages are returned as an iterator instead (columnar pages hold
+        lists).
+        """
         self._logger.info(
             {
                 "message": "Running query",
@@ -176,14 +441,24 @@ class Timestream:
         result_iterator = self._paginate_query(
             sql,
             pagination_config={'PageSize': page_size},
-            transform=transform
+            transform=transform,
+            columnar=columnar,
+            stats=stats
         )
 
         if chunked:
-            return result_iterator
+            return (page for _, page in result_iterator)
+
+        if columnar:
+            decoder = None
+            columns: Dict[str, list] = {}
+            for decoder, page in result_iterator:
+                for name, values in page.items():
+                    columns.setdefault(name, []).extend(values)
+            return decoder.to_arrays(columns) if decoder is not None else columns
 
         rows = []
-        for row_batch in result_iterator:
+        for _, row_batch in result_iterator:
             rows.extend(row_batch)
         self._logger.info(
             {
@@ -194,72 +469,193 @@ class Timestream:
         return rows
 
     @staticmethod
-    def _prepare_records(
-        rows: List[Dict[str, Any]],
+    def _record_template(
         col_types: Dict[str, Any],
         time_col: str,
         measure_cols: List[str],
-        dimension_cols: List[str]
-    ):
-        records = []
+        dimension_cols: List[str],
+        common_dimension_cols: List[str],
+    ) -> RecordTemplate:
+        key = (
+            tuple((col, str(col_type)) for col, col_type in col_types.items()),
+            time_col,
+            tuple(measure_cols),
+            tuple(dimension_cols),
+            tuple(common_dimension_cols),
+        )
+        template = _record_templates.get(key)
+        if template is None:
+            def _typed(col):
+                col_type = str(col_types.get(col))
+                return col, col_type, _value_encoders[col_type]
+
+            template = RecordTemplate(
+                time_col=time_col,
+                dimensions=[
+                    _typed(col)
+                    for col in dimension_cols
+                    if col not in common_dimension_cols
+                ],
+                common_dimensions=[_typed(col) for col in common_dimension_cols],
+                measures=[_typed(col) for col in measure_cols],
+            )
+            _record_templates[key] = template
+        return template
+
+    @staticmethod
+    def _prepare_records(
+        rows: List[Dict[str, Any]],
+        template: RecordTemplate
+    ) -> List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """
+        Builds records from rows, grouped by the values of the template's
+        common dimensions.
+
+        Returns:
+            list: (common attributes, records) pairs, one per group
+        """
+        groups: Dict[tuple, List[Dict[str, Any]]] = {}
         for row in rows:
-            dimensions = [
-                {
-                    'Name': col,
-                    'Value': value,
-                    'DimensionValueType': str(col_types.get(col))
-                }
-                for col, value in row.items()
-                if col in dimension_cols
-            ]
-            timestamp = row.get(time_col)
+            common_values = tuple(row[col] for col, _, _ in template.common_dimensions)
+            records = groups.get(common_values)
+            if records is None:
+                records = groups[common_values] = []
             records.append(
                 {
-                    'Dimensions': dimensions,
-                    'Time': timestamp,
-                    'TimeUnit': 'MILLISECONDS',
-                    'MeasureName': 'record',
-                    'MeasureValueType': 'MULTI',
+                    'Dimensions': [
+                        {
+                            'Name': col,
+                            'Value': encode(row[col]),
+                            'DimensionValueType': col_type
+                        }
+                        for col, col_type, encode in template.dimensions
+                    ],
+                    'Time': str(row[template.time_col]),
                     'MeasureValues': [
                         {
                             'Name': col,
-                            'Value': value,
-                            'Type': str(col_types.get(col))
+                            'Value': encode(row[col]),
+                            'Type': col_type
                         }
-                        for col, value in row.items()
-                        if col in measure_cols
+                        for col, col_type, encode in template.measures
                     ]
                 }
             )
-        return records
 
-    def _write_record_batch(self, record_batch):
+        prepared = []
+        for common_values, records in groups.items():
+            common_attributes = {
+                'Dimensions': [
+                    {
+                        'Name': col,
+                        'Value': encode(value),
+                        'DimensionValueType': col_type
+                    }
+                    for (col, col_type, encode), value in zip(
+                        template.common_dimensions,
+                        common_values
+                    )
+                ],
+                'TimeUnit': 'MILLISECONDS',
+                'MeasureName': 'record',
+                'MeasureValueType': 'MULTI',
+            }
+            prepared.append((common_attributes, records))
+        return prepared
+
+    def _write_record_batch(
+        self,
+        record_batch,
+        common_attributes,
+        attempt=0
+    ) -> List[Tuple[list, dict, int]]:
+        """
+        Sends one WriteRecords request.
+
+        Returns:
+            list: (records, common attributes, attempt) batches to requeue,
+                made of the records that were throttled or rejected for a
+                retryable reason
+        """
+        controller = self.write_controller
+        exceptions = self._write_client.exceptions
+        throttled = False
+        retry_records = []
+        records_written = len(record_batch)
+        request_start = time.monotonic()
         try:
             self._write_client.write_records(
                 DatabaseName=self._db,
                 TableName=self._table,
+                CommonAttributes=common_attributes,
                 Records=record_batch
             )
-        except self._write_client.exceptions.RejectedRecordsException as e:
+        except (exceptions.ThrottlingException, exceptions.InternalServerException) as e:
+            throttled = isinstance(e, exceptions.ThrottlingException)
+            retry_records = record_batch
+            records_written = 0
+        except _retryable_connection_errors as e:
+            self._logger.warning({"message": "WriteRecords failed", "error": repr(e)})
+            retry_records = record_batch
+            records_written = 0
+        except exceptions.RejectedRecordsException as e:
             self._logger.error({"RejectedRecords": e})
-            for rr in e.response["RejectedRecords"]:
+            rejected_records = e.response["RejectedRecords"]
+            records_written -= len(rejected_records)
+            for rr in rejected_records:
                 self._logger.error(
                     f"Rejected index {rr['RecordIndex']}: {rr['Reason']}"
                 )
+                if any(marker in rr["Reason"].lower() for marker in _retryable_reasons):
+                    retry_records.append(record_batch[rr["RecordIndex"]])
+                else:
+                    controller.record_dropped(1)
+        finally:
+            controller.release(
+                time.monotonic() - request_start,
+                throttled,
+                records_written
+            )
 
-    def _write_records(self, records):
-        batches_of_records = create_batches_from_list(records, batch_size)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-            future_to_batch_write = {
-                executor.submit(self._write_record_batch, batch)
-                for batch in batches_of_records
-            }
-            with timed_operation("timestream", "basic_write", num_records=len(records)):
-                for future in concurrent.futures.as_completed(future_to_batch_write):
-                    try:
-                        future.result()
-                    except Exception as exc:
-                        raise exc
+        if not retry_records:
+            return []
+        if attempt >= write_max_retries:
+            controller.record_dropped(len(retry_records))
+            return []
+        controller.record_requeued(len(retry_records))
+        # Jittered backoff before the records go back in the queue
+        time.sleep(random.uniform(0, min(10, 0.1 * 2 ** attempt)))
+        return [(retry_records, common_attributes, attempt + 1)]
+
+    def _write_records(self, grouped_records, timer: timed_operation):
+        pending = collections.deque(
+            (batch, common_attributes, 0)
+            for common_attributes, records in grouped_records
+            for batch in create_batches_from_list(records, batch_size)
+        )
+        controller = self.write_controller
+        with concurrent.futures.ThreadPoolExecutor(max_workers=controller.max_limit) as executor:
+            before = controller.snapshot()
+            futures = set()
+            while pending or futures:
+                while pending and controller.try_acquire():
+                    futures.add(
+                        executor.submit(self._write_record_batch, *pending.popleft())
+                    )
+                done, futures = concurrent.futures.wait(
+                    futures,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    pending.extend(future.result())
+            after = controller.snapshot()
+        timer.attributes["in_flight_limit"] = after["in_flight_limit"]
+        timer.add_phase(
+            "send",
+            (after["request_seconds"] - before["request_seconds"]) * 1e9
+        )
+        for counter in ("throttles", "requeued_records", "dropped_records"):
+            timer.attributes[counter] = after[counter] - before[counter]
 
     def write(
         self,
@@ -267,8 +663,17 @@ class Timestream:
         col_types: Dict[str, Any],
         time_col: str,
         measure_col: Union[str, List[str]],
-        dimensions_cols: List[str]
+        dimensions_cols: List[str],
+        common_dimensions_cols: List[str] = None
     ):
+        """
+        Writes rows as multi-measure records.
+
+        Dimensions listed in `common_dimensions_cols` are expected to take few
+        distinct values (e.g. batch-level attributes): rows are grouped by
+        them and they are sent once per WriteRecords call as common
+        attributes instead of with every record.
+        """
         if len(rows) == 0:
             return
 
@@ -284,11 +689,32 @@ class Timestream:
         if isinstance(measure_col, str):
             measure_col = [measure_col]
 
-        records = Timestream._prepare_records(
-            rows,
+        template = Timestream._record_template(
             col_types,
             time_col,
             measure_col,
-            dimensions_cols
+            dimensions_cols,
+            common_dimensions_cols or []
         )
-        self._write_records(records)
+        # Serializing the records is part of the write, as it is for the
+        # other stores
+        with timed_operation("timestream", "basic_write", num_records=len(rows)) as timer:
+            with timer.phase("serialize"):
+                grouped_records = Timestream._prepare_records(rows, template)
+            self._write_records(grouped_records, timer)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Timestream:
+    """
+    Returns the process-wide Timestream client, so that warm invocations
+    reuse its boto3 clients and connection pools.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Timestream()
+        return _client
@@ -1,27 +1,87 @@
+import concurrent.futures
+import os
 import time
-from copy import deepcopy
-from datetime import datetime
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
 from logging import Logger
-from typing import List
+from typing import Dict
 
-from src.events import IngestionEvent
+from src.events import EventBatch, event_fields
 from src import cloudwatch as cw
 from src import es
 from src import postgres as rds
 from src import timestream as ts
-from src.helpers import DataType
+from src.helpers import DataType, timed_operation
 
 log = Logger(name="write_helper")
+# One of "insert" (one multi-row INSERT per batch of rows), "copy_csv" or
+# "copy_binary"
+rds_write_mode = os.getenv("RDS_WRITE_MODE", "insert")
+rds_copy_commit_every = int(os.getenv("RDS_COPY_COMMIT_EVERY", "0")) or None
+# Tables whose schema has been set up by this (possibly warm) process
+_rds_tables_created = set()
+# Indices (or rolled index families) set up by this process, and when their
+# rollover conditions were last checked
+_es_indices_created = set()
+_es_last_rollover_check = {}
+es_rollover_check_interval = 300
 
 
-def _write_to_cw(events: List[dict]):
+def _write_to_cw(event_batch: EventBatch):
     now = time.localtime()
     log_stream = f"{now.tm_year}/{now.tm_mon}/{now.tm_mday}/{now.tm_hour}/{now.tm_min}"
-    cw.write_many(log_stream, events)
+    cw.write_many(log_stream, event_batch.as_dicts())
 
 
-def _write_to_es(events: List[dict]):
-    field_types = IngestionEvent.get_types_for_event_fields()
+es_index = "monitoring_events"
+# Last document written to ES ("document") and when its bulk write returned
+# ("written_at_ns", perf_counter_ns), which its freshness lag is timed from
+_es_last_write = {}
+
+
+def _es_freshness_query(document: dict) -> dict:
+    return {
+        "bool": {
+            "filter": [
+                {"term": {"job_id": document["job_id"]}},
+                {"term": {"stage_progress": document["stage_progress"]}},
+            ]
+        }
+    }
+
+
+def _time_es_freshness_lag():
+    # How long the last document written takes to become searchable. Run
+    # outside the write timers and error handling: a failed check does not
+    # fail the write
+    if not _es_last_write:
+        return
+    try:
+        with timed_operation(
+            es.data_store,
+            "freshness_lag",
+            ingest_mode=es.ingest_mode_enabled,
+        ) as timer:
+            # From when the bulk write returned, not from when polling starts
+            timer.start_time_ns = _es_last_write["written_at_ns"]
+            timer.attributes["became_searchable"] = es.wait_until_searchable(
+                es.read_target(es_index),
+                _es_freshness_query(_es_last_write["document"])
+            )
+    except Exception as exc:
+        log.error(
+            {
+                "message": "Could not time freshness lag",
+                "data_store": es.data_store,
+                "error": repr(exc)
+            }
+        )
+    finally:
+        _es_last_write.clear()
+
+
+def _set_up_es_index():
+    field_types = EventBatch.get_types_for_event_fields()
     es_type_for_data = {
         DataType.STRING: "keyword",
         DataType.INTEGER: "integer",
@@ -36,13 +96,88 @@ def _write_to_es(events: List[dict]):
             }
         }
     }
-    index = "monitoring_events"
-    es.create_index_if_not_exists(index, index_settings)
-    es.index_documents_in_bulk(index, events)
+    index = es_index
+    if es.index_layout == "rolled":
+        if index not in _es_indices_created:
+            es.put_index_template(
+                index,
+                [f"{index}-*"],
+                {**index_settings, "aliases": {es.read_target(index): {}}}
+            )
+            es.bootstrap_rolled_index(index)
+            # Whatever ES_INGEST_MODE says now, settings left tuned by a run
+            # that died in ingest mode are put back
+            es.restore_ingest_mode_settings(es.read_target(index))
+            _es_indices_created.add(index)
+        now = time.time()
+        if now - _es_last_rollover_check.get(index, 0) > es_rollover_check_interval:
+            es.rollover(es.write_target(index), es.rollover_conditions)
+            if es.index_retention_days:
+                es.delete_expired_indices(index, es.index_retention_days)
+            _es_last_rollover_check[index] = now
+    elif index not in _es_indices_created:
+        es.create_index_if_not_exists(index, index_settings)
+        es.restore_ingest_mode_settings(index)
+        _es_indices_created.add(index)
 
 
-def _write_to_rds(events: List[dict]):
-    field_types = IngestionEvent.get_types_for_event_fields()
+@contextmanager
+def write_session():
+    """
+    Per-invocation write state, entered around all of the invocation's
+    stage waves. With ES_INGEST_MODE, the ES write index stays in ingest mode
+    for the whole invocation (rather than being switched in and out on every
+    wave), and freshness is timed once, for the last document written.
+    """
+    _es_last_write.clear()
+    if not es.ingest_mode_enabled:
+        yield
+        return
+
+    entered = False
+    with ExitStack() as stack:
+        try:
+            _set_up_es_index()
+            stack.enter_context(
+                es.ingest_mode(
+                    es.write_target(es_index),
+                    drop_replicas=es.ingest_mode_drop_replicas,
+                    async_translog=es.ingest_mode_async_translog,
+                )
+            )
+            entered = True
+        except Exception as exc:
+            # The ES writer reports its own failures; the other stores
+            # still get written
+            log.error(
+                {
+                    "message": "Could not enter ingest mode",
+                    "data_store": es.data_store,
+                    "error": repr(exc)
+                }
+            )
+        yield
+    if entered:
+        _time_es_freshness_lag()
+
+
+def _write_to_es(event_batch: EventBatch):
+    _set_up_es_index()
+    documents = event_batch.as_dicts()
+    if len(documents) == 0:
+        return
+    with timed_operation(
+        es.data_store,
+        "ingest_write",
+        num_records=len(documents),
+        ingest_mode=es.ingest_mode_enabled,
+    ):
+        es.index_documents_in_bulk(es.write_target(es_index), documents)
+    _es_last_write.update(document=documents[-1], written_at_ns=time.perf_counter_ns())
+
+
+def _write_to_rds(event_batch: EventBatch):
+    field_types = EventBatch.get_types_for_event_fields()
     postgres_type_for_data = {
         DataType.STRING: "text",
         DataType.INTEGER: "integer",
@@ -55,35 +190,95 @@ def _write_to_rds(events: List[dict]):
         for field, field_type in field_types.items()
     }
     col_name_and_types["id"] = "serial"
-    for event in events:
-        for field, value in event.items():
-            if field_types.get(field) == DataType.TIMESTAMP:
-                event[field] = datetime.fromtimestamp(value / 1000)
+    timestamp_cols = [
+        i for i, field in enumerate(event_fields)
+        if field_types.get(field) == DataType.TIMESTAMP
+    ]
+
+    def _rows():
+        for row in event_batch.rows(event_fields):
+            row = list(row)
+            for i in timestamp_cols:
+                row[i] = datetime.fromtimestamp(row[i] / 1000)
+            yield tuple(row)
+
+    derived_tables = [
+        rds.BatchSummaryTable(list(event_fields)),
+        rds.JobLatestStateTable(list(event_fields)),
+    ] if rds.derived_tables_enabled else []
+
     with rds.PSQLConnection() as connection:
-        connection.create_table(table, "id", col_name_and_types)
-        connection.create_index(table, "ingestion_batch_id")
-        connection.create_index(table, "user_id")
-        connection.create_index(table, "repo_id")
-        connection.create_index(table, "job_id")
-        connection.create_index(table, "created_at")
-        connection.create_index(table, "time")
-        connection.insert_rows(table, events)
-
-
-def _write_to_ts(events: List[dict]):
-    field_types = IngestionEvent.get_types_for_event_fields()
-    field_types["created_at"] = DataType.STRING
-    field_types["num_stages"] = DataType.STRING
-    for event in events:
-        for field, value in event.items():
-            event[field] = str(value)
-
-    ts_client = ts.Timestream()
-    ts_client.write(
-        events,
+        for derived_table in derived_tables:
+            if derived_table.table not in _rds_tables_created:
+                derived_table.create(connection)
+                _rds_tables_created.add(derived_table.table)
+        if table not in _rds_tables_created:
+            existing_layout = connection.get_table_layout(table)
+            if existing_layout not in (None, rds.table_layout):
+                raise ValueError(
+                    f"{table} already exists with the {existing_layout} layout; "
+                    f"use a separate database for the {rds.table_layout} layout"
+                )
+            if rds.table_layout == "partitioned":
+                connection.create_partitioned_table(
+                    table, "id", "time", col_name_and_types
+                )
+            else:
+                connection.create_table(table, "id", col_name_and_types)
+            connection.create_index(table, "ingestion_batch_id")
+            connection.create_index(table, "user_id")
+            connection.create_index(table, "repo_id")
+            connection.create_index(table, "job_id")
+            connection.create_index(table, "created_at")
+            connection.create_index(table, "time")
+            _rds_tables_created.add(table)
+        event_times = event_batch.columns()["time"]
+        if rds.table_layout == "partitioned" and event_times:
+            connection.ensure_partitions(
+                table,
+                datetime.fromtimestamp(min(event_times) / 1000),
+                datetime.fromtimestamp(max(event_times) / 1000),
+            )
+            if rds.partition_retention_days:
+                connection.expire_partitions(
+                    table,
+                    timedelta(days=rds.partition_retention_days),
+                    drop=rds.drop_expired_partitions,
+                )
+        if rds_write_mode.startswith("copy_"):
+            connection.copy_rows(
+                table,
+                list(event_fields),
+                _rows(),
+                col_types=col_name_and_types,
+                copy_format=rds_write_mode[len("copy_"):],
+                commit_every=rds_copy_commit_every,
+                derived_tables=derived_tables,
+            )
+        else:
+            connection.insert_rows(
+                table,
+                list(event_fields),
+                list(_rows()),
+                derived_tables=derived_tables,
+            )
+
+
+def _write_to_ts(event_batch: EventBatch):
+    field_types = EventBatch.get_types_for_event_fields()
+
+    ts.get_client().write(
+        event_batch.as_dicts(),
         field_types,
         "time",
-        ["stage", "stage_progress", "errored", "finished"],
+        [
+            "stage",
+            "stage_progress",
+            "errored",
+            "finished",
+            "created_at",
+            "num_stages",
+        ],
         [
             "ingestion_batch_id",
             "org_id",
@@ -93,24 +288,83 @@ def _write_to_ts(events: List[dict]):
             "priority",
             "job_id",
             "job_type",
-            "created_at",
             "dataset_id",
-            "num_stages",
+        ],
+        [
+            "ingestion_batch_id",
+            "org_id",
+            "user_id",
+            "repo_id",
+            "repo_version",
+            "priority",
         ]
     )
 
 
-def write_events(events: List[dict]):
-    print(f"Writing {len(events)} events...")
+store_writers = {
+    "cloudwatch": _write_to_cw,
+    "elasticsearch": _write_to_es,
+    "rds": _write_to_rds,
+    "timestream": _write_to_ts,
+}
+# Names the stores' writes are recorded under elsewhere, which tell the ES
+# index and RDS table layouts apart
+store_data_stores = {
+    "cloudwatch": "cloudwatch_logs",
+    "elasticsearch": es.data_store,
+    "rds": rds.data_store,
+    "timestream": "timestream",
+}
 
-    print("-> cloudwatch")
-    _write_to_cw(deepcopy(events))
 
-    print("-> elasticsearch")
-    _write_to_es(deepcopy(events))
+def _timed_wave_write(store: str, event_batch: EventBatch, read_workers: int):
+    with timed_operation(
+        store_data_stores[store],
+        "wave_write",
+        num_records=event_batch.num_active_jobs,
+        read_workers=read_workers,
+    ):
+        store_writers[store](event_batch)
+    if store == "elasticsearch" and not es.ingest_mode_enabled:
+        # Right after the write rather than once every store is done, so
+        # that the lag is not padded by polling late
+        _time_es_freshness_lag()
 
-    print("-> rds")
-    _write_to_rds(deepcopy(events))
 
-    print("-> timestream")
-    _write_to_ts(deepcopy(events))
+def write_events(event_batch: EventBatch, read_workers: int = 0) -> Dict[str, Exception]:
+    """
+    Writes the current stage wave of `event_batch` to all the data stores
+    concurrently. Every store serializes from the same read-only batch, so a
+    wave takes roughly as long as the slowest store.
+
+    A failing store does not stop the others: its exception is logged and
+    returned, keyed by store name.
+
+    Args:
+        read_workers: Readers per store querying while the wave is written,
+            recorded with each store's wave write
+    """
+    print(f"Writing {event_batch.num_active_jobs} events...")
+
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(store_writers)) as executor:
+        future_to_store = {
+            executor.submit(_timed_wave_write, store, event_batch, read_workers): store
+            for store in store_writers
+        }
+        for future in concurrent.futures.as_completed(future_to_store):
+            store = future_to_store[future]
+            try:
+                future.result()
+                print(f"-> {store}")
+            except Exception as exc:
+                log.error(
+                    {
+                        "message": "Write failed",
+                        "data_store": store,
+                        "error": repr(exc)
+                    }
+                )
+                print(f"-> {store} (failed: {exc!r})")
+                errors[store] = exc
+    return errors